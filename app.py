@@ -0,0 +1,103 @@
+"""
+Builds the bot for main.py and async_main.py.
+
+Importing bot_manager or async_bot_manager only reads settings.ini and
+declares the bot and its handlers, whose logic lives in handlers; the
+database engine is created, bound to the sessions and instrumented here,
+the schema is brought up to date and the caches are optionally
+preloaded, in that order, before the first update is taken.
+"""
+import logging
+import time
+
+import db_manager as dbm
+import migrations
+from metrics import create_metrics_server
+
+logger = logging.getLogger(__name__)
+
+
+class Application:
+    """
+    The built bot and what it runs on.
+
+    Attributes:
+        config (ConfigParser): The settings read from settings.ini.
+        bot (TeleBot or AsyncTeleBot): The bot with its handlers.
+        engine (Engine or AsyncEngine): The database engine.
+        metrics_server (MetricsServer): The Prometheus endpoint,
+                                        None when it is disabled.
+        startup_seconds (float): How long building the application took.
+    """
+    def __init__(self, config, bot, engine, metrics_server,
+                 startup_seconds):
+        self.config = config
+        self.bot = bot
+        self.engine = engine
+        self.metrics_server = metrics_server
+        self.startup_seconds = startup_seconds
+
+
+def _startup_done(started, warmed_up):
+    startup_seconds = time.perf_counter() - started
+    logger.info('Бот готов к работе за %.3f с%s', startup_seconds,
+                ' (кэши прогреты)' if warmed_up else '')
+    return startup_seconds
+
+def create_app(engine = None):
+    """
+    Builds the polling or webhook bot.
+
+    Args:
+        engine (Engine): The engine to use instead of the one configured
+                         in settings.ini.
+
+    Returns:
+        Application: The bot, ready to start taking updates.
+    """
+    # Importing the handlers is most of the startup, so it is measured too.
+    started = time.perf_counter()
+    import bot_manager as bm
+    bm.update_metrics.mark_started(started)
+    config = bm.config
+    # Creating an engine does not connect, the first connection is opened
+    # by the schema check.
+    engine = engine or dbm.create_engine(config)
+    dbm.configure_session(engine)
+    bm.query_monitor.install(engine)
+    migrations.migrate(engine)
+    warm_up = config.getboolean('Startup', 'warm_up', fallback = False)
+    if warm_up:
+        with dbm.session_scope() as session:
+            dbm.warm_up(session)
+    return Application(config, bm.bot, engine,
+                       create_metrics_server(bm.update_metrics, config),
+                       _startup_done(started, warm_up))
+
+async def create_async_app(engine = None):
+    """
+    Builds the asyncio bot, see create_app.
+
+    Args:
+        engine (AsyncEngine): The engine to use instead of the one
+                              configured in settings.ini.
+
+    Returns:
+        Application: The bot, ready to start taking updates.
+    """
+    started = time.perf_counter()
+    import async_bot_manager as abm
+    import async_db_manager as adbm
+    import handlers
+    handlers.update_metrics.mark_started(started)
+    config = handlers.config
+    engine = engine or adbm.create_engine(config)
+    adbm.configure_session(engine)
+    handlers.query_monitor.install(engine.sync_engine)
+    await adbm.migrate(engine)
+    warm_up = config.getboolean('Startup', 'warm_up', fallback = False)
+    if warm_up:
+        await adbm.run_sync(dbm.warm_up)
+    return Application(config, abm.bot, engine,
+                       create_metrics_server(handlers.update_metrics, config),
+                       _startup_done(started, warm_up))
@@ -0,0 +1,251 @@
+import asyncio
+import functools
+import logging
+import tempfile
+import aiohttp
+from sqlalchemy.exc import SQLAlchemyError
+from telebot import asyncio_filters, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_storage import StateMemoryStorage
+
+import async_db_manager as adbm
+import db_manager as dbm
+import handlers
+import vocabulary_import
+from card_queue import NoCardQueue
+from handlers import (TOKEN, ADMINS, IMPORT_TIMEOUT, query_monitor,
+                      update_metrics, update_label, lessons, AddWordStates,
+                      DeleteWordStates)
+from keyboards import Command
+from text_dispatch import TextDispatcher
+
+logger = logging.getLogger(__name__)
+
+bot = AsyncTeleBot(TOKEN, state_storage = StateMemoryStorage())
+bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+
+card_queue = NoCardQueue()
+
+
+def per_update(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, *args, **kwargs):
+        with (update_metrics.track(handler.__name__, update_label(update)),
+              query_monitor.track(handler.__name__)):
+            return await handler(update, *args, **kwargs)
+    return wrapper
+
+text_dispatcher = TextDispatcher(handlers.get_answer_options)
+update_metrics.add_source('text_dispatch_messages', text_dispatcher.stats,
+                          label = 'handler')
+
+
+async def deliver(replies, chat_id, message_id = None, call_id = None):
+    for reply in replies:
+        if reply.method == 'answer_callback_query':
+            await bot.answer_callback_query(call_id, reply.content,
+                                            **reply.options)
+        elif reply.method == 'edit_message_text':
+            await bot.edit_message_text(reply.content, chat_id, message_id,
+                                        **reply.options)
+        elif reply.method == 'send_document':
+            with reply.content:
+                await bot.send_document(chat_id, reply.content,
+                                        **reply.options)
+        else:
+            await getattr(bot, reply.method)(chat_id, reply.content,
+                                             **reply.options)
+
+
+@bot.message_handler(state = AddWordStates.russian_added_word)
+@per_update
+async def handle_russian_word(message):
+    async with bot.retrieve_data(message.from_user.id,
+                                 message.chat.id) as data:
+        data['russian_word'] = message.text.lower()
+    await deliver(handlers.russian_word_replies(), message.chat.id)
+    await bot.set_state(message.from_user.id,
+                        AddWordStates.english_added_word, message.chat.id)
+
+@bot.message_handler(state = AddWordStates.english_added_word)
+@per_update
+async def handle_english_word(message):
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    async with bot.retrieve_data(message.from_user.id,
+                                 message.chat.id) as data:
+        russian_word = data['russian_word']
+    try:
+        replies = await adbm.run_sync(
+            lambda session: handlers.english_word_replies(
+                session, message.from_user.id, russian_word,
+                message.text.lower(), lesson))
+    finally:
+        await bot.delete_state(message.from_user.id, message.chat.id)
+    await deliver(replies, message.chat.id)
+
+async def download_document(file_id, file):
+    # Streams the file to disk in READ_SIZE chunks through the bot's own
+    # aiohttp session, so an upload is never held in memory whole.
+    url = await bot.get_file_url(file_id)
+    session = await asyncio_helper.session_manager.get_session()
+    timeout = aiohttp.ClientTimeout(sock_connect = IMPORT_TIMEOUT,
+                                    sock_read = IMPORT_TIMEOUT)
+    async with session.get(url, proxy = asyncio_helper.proxy,
+                           timeout = timeout) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(
+                vocabulary_import.READ_SIZE):
+            file.write(chunk)
+    file.seek(0)
+
+async def import_document(chat_id, user_name, pairs, counts):
+    # The async session can't be used from a worker thread, so the pairs
+    # are parsed there a batch at a time and each batch is stored on the
+    # loop before the next is read. Only one batch is held in memory.
+    texts = []
+    progress = handlers.import_progress(texts.append)
+    added = skipped = 0
+    try:
+        while batch := await asyncio.to_thread(handlers.read_batch, pairs):
+            imported = await adbm.run_sync(
+                lambda session: dbm.import_pairs(session, user_name, batch))
+            if imported is None:
+                return handlers.imported_replies(None, counts)
+            added += imported[0]
+            skipped += imported[1]
+            progress(added + skipped, added)
+            for text in texts:
+                await bot.send_message(chat_id, text)
+            texts.clear()
+    except (ValueError, SQLAlchemyError) as e:
+        return handlers.import_failed_replies(e)
+    finally:
+        card_queue.invalidate(user_name)
+    return handlers.imported_replies((added, skipped), counts)
+
+@bot.message_handler(content_types = ['document'])
+@per_update
+async def handle_document(message):
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    document = message.document
+    lesson = lessons.get(user_id, chat_id)
+    rejection = handlers.document_rejection(document)
+    if rejection:
+        await deliver(rejection, chat_id)
+        return
+    await deliver(handlers.document_accepted(document), chat_id)
+    try:
+        with tempfile.TemporaryFile() as file:
+            await download_document(document.file_id, file)
+            pairs, counts = handlers.read_document(
+                iter(functools.partial(file.read,
+                                       vocabulary_import.READ_SIZE), b''),
+                document.file_name)
+            replies = await import_document(chat_id, user_id, pairs, counts)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logger.exception('Не удалось скачать файл %s', document.file_name)
+        replies = handlers.download_failed_replies()
+    await deliver(replies + handlers.next_action_replies(lesson), chat_id)
+
+@bot.message_handler(state = DeleteWordStates.deleted_word)
+@per_update
+async def handle_word_to_delete(message):
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    try:
+        replies = await adbm.run_sync(
+            lambda session: handlers.word_to_delete_replies(
+                session, card_queue, message.from_user.id,
+                message.text.lower(), lesson))
+    finally:
+        await bot.delete_state(message.from_user.id, message.chat.id)
+    await deliver(replies, message.chat.id)
+
+@bot.message_handler(commands = ['start'])
+@per_update
+async def start_command(message):
+    await deliver(handlers.start_replies(), message.chat.id)
+    await adbm.run_sync(
+        lambda session: handlers.start(session, message.from_user.id))
+
+@bot.callback_query_handler(func = lambda call: True)
+@per_update
+async def callback_all_commands(call):
+    if not call.message:
+        return
+    chat_id = call.message.chat.id
+    lesson = lessons.get(call.from_user.id, chat_id)
+    replies = await adbm.run_sync(
+        lambda session: handlers.callback_replies(session, card_queue, call,
+                                                  lesson))
+    await deliver(replies, chat_id, call.message.message_id, call.id)
+
+@text_dispatcher.command(Command.ADD_WORD)
+@per_update
+async def handle_add_word(message):
+    await deliver(handlers.add_word_replies(), message.chat.id)
+    await bot.set_state(message.from_user.id,
+                        AddWordStates.russian_added_word, message.chat.id)
+
+@text_dispatcher.command(Command.DELETE_WORD)
+@per_update
+async def handle_delete_word(message):
+    await deliver(handlers.delete_word_replies(), message.chat.id)
+    await bot.set_state(message.from_user.id, DeleteWordStates.deleted_word,
+                        message.chat.id)
+
+@bot.message_handler(commands = ['reset_progress'])
+@per_update
+async def handle_reset_progress(message):
+    await deliver(handlers.reset_progress_replies(), message.chat.id)
+
+@text_dispatcher.answer
+@per_update
+async def handle_translation_choice(message):
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    replies = await adbm.run_sync(
+        lambda session: handlers.translation_choice_replies(
+            session, card_queue, message.from_user.id, lesson,
+            message.text))
+    await deliver(replies, message.chat.id)
+
+@text_dispatcher.command(Command.NEXT_WORD)
+@per_update
+async def handle_next_word(message):
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    replies = await adbm.run_sync(
+        lambda session: handlers.next_word_replies(
+            session, card_queue, message.from_user.id, lesson))
+    await deliver(replies, message.chat.id)
+
+@text_dispatcher.command(Command.END)
+@per_update
+async def handle_end_lesson(message):
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    await deliver(handlers.end_lesson_replies(lesson), message.chat.id)
+
+@bot.message_handler(commands = ['export'])
+@per_update
+async def handle_export(message):
+    file_format, user_name = handlers.export_arguments(message)
+    replies = await adbm.run_sync(
+        lambda session: handlers.export_replies(session, user_name,
+                                                file_format))
+    await deliver(replies, message.chat.id)
+
+@bot.message_handler(commands = ['help'])
+@per_update
+async def help_command(message):
+    await deliver(handlers.help_replies(), message.chat.id)
+
+@bot.message_handler(commands = ['metrics_dump'],
+                     func = lambda message: message.from_user.id in ADMINS)
+@per_update
+async def metrics_dump(message):
+    await deliver(handlers.metrics_replies(), message.chat.id)
+
+@bot.message_handler(content_types = ['text'])
+async def dispatch_text(message):
+    handler = text_dispatcher.route(message)
+    if handler is not None:
+        await handler(message)
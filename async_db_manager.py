@@ -0,0 +1,44 @@
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import db_manager as dbm
+import migrations
+
+AsyncSession = async_sessionmaker(expire_on_commit = False)
+
+
+def create_engine(config = None):
+    config = config or dbm.read_settings()
+    statement_timeout = config.get('Database', 'statement_timeout',
+                                   fallback = '5000')
+    engine = create_async_engine(
+        dbm.get_dsn(config, 'postgresql+asyncpg'),
+        pool_size = config.getint('Database', 'pool_size', fallback = 10),
+        max_overflow = config.getint('Database', 'max_overflow',
+                                     fallback = 5),
+        pool_timeout = config.getint('Database', 'pool_timeout',
+                                     fallback = 10),
+        pool_recycle = config.getint('Database', 'pool_recycle',
+                                     fallback = 1800),
+        pool_pre_ping = config.getboolean('Database', 'pool_pre_ping',
+                                          fallback = True),
+        connect_args = {'server_settings':
+                            {'statement_timeout': statement_timeout}}
+    )
+    return engine
+
+def configure_session(engine):
+    AsyncSession.configure(bind = engine)
+
+async def migrate(engine):
+    async with engine.connect() as connection:
+        if await connection.run_sync(migrations.is_current):
+            return []
+    async with engine.begin() as connection:
+        return await connection.run_sync(migrations.upgrade)
+
+async def run_sync(function):
+    # The async API of db_manager: function(session) runs with the sync
+    # Session of an AsyncSession, so every db_manager and handlers function
+    # can be awaited without an async copy of its own.
+    async with AsyncSession() as session:
+        return await session.run_sync(function)
@@ -0,0 +1,16 @@
+import asyncio
+
+from app import create_async_app
+
+
+async def main():
+    app = await create_async_app()
+    if app.metrics_server:
+        app.metrics_server.start()
+    try:
+        await app.bot.infinity_polling()
+    finally:
+        await app.engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
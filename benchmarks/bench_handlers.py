@@ -0,0 +1,310 @@
+"""
+Drives the real bot handlers with synthetic updates and reports latency,
+SQL statements and memory per scenario.
+
+Usage (from the project root):
+    python -m benchmarks.bench_handlers [--dsn DSN] [--words 1000]
+        [--users 20] [--rounds 5] [--output results.json]
+        [--baseline previous.json]
+
+Telegram is replaced by a stub that records the outgoing API calls, and the
+handlers run against a throwaway database: a temporary SQLite file by
+default, or the database of --dsn, whose tables are dropped afterwards, so
+only point it at an empty test database. The base dictionary is generated
+with --words pairs.
+
+For every scenario the p50/p99 handler latency, the SQL statements run by
+the handler and by the background card queue, the Telegram API calls and
+the peak memory allocated by one run are printed and saved as JSON.
+"""
+import argparse
+import configparser
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import sqlalchemy
+from sqlalchemy import event
+from telebot import apihelper, types
+from telebot.util import CustomRequestResponse
+
+from benchmarks.bench_start import write_seed_file
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_TOKEN = '0:benchmark'
+SCENARIOS = ('start', 'next_word', 'answer', 'add', 'delete', 'reset')
+
+
+class FakeTelegram:
+    """
+    Answers Bot API requests locally and records them.
+
+    Attributes:
+        calls (list): The names of the API methods called.
+    """
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def __call__(self, method, url, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls.append(api_method)
+            self._message_id += 1
+            message_id = self._message_id
+        if api_method in ('sendMessage', 'sendSticker', 'sendDocument',
+                          'editMessageText'):
+            result = {'message_id': message_id, 'date': 0,
+                      'chat': {'id': 0, 'type': 'private'}}
+        else:
+            result = True
+        return CustomRequestResponse(json.dumps({'ok': True,
+                                                 'result': result}))
+
+
+class Updates:
+    """Builds synthetic private chat messages and callback queries."""
+    def __init__(self):
+        self._next_id = 0
+
+    def _id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def message(self, user_id, text):
+        update_id = self._id()
+        message = {'message_id': update_id, 'date': 0,
+                   'chat': {'id': user_id, 'type': 'private'},
+                   'from': {'id': user_id, 'is_bot': False,
+                            'first_name': 'bench'},
+                   'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        return types.Update.de_json({'update_id': update_id,
+                                     'message': message})
+
+    def callback(self, user_id, data):
+        update_id = self._id()
+        return types.Update.de_json({
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id), 'chat_instance': 'bench',
+                'data': data,
+                'from': {'id': user_id, 'is_bot': False,
+                         'first_name': 'bench'},
+                'message': {'message_id': update_id, 'date': 0,
+                            'chat': {'id': user_id, 'type': 'private'},
+                            'text': 'bench'}
+            }
+        })
+
+
+def write_settings(directory):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(PROJECT_DIR, 'settings.ini'))
+    if not config.has_section('Tokens'):
+        config.add_section('Tokens')
+    config['Tokens']['TOKEN'] = FAKE_TOKEN
+    for key in ('db_name', 'user', 'password', 'host', 'port'):
+        config['Tokens'].setdefault(key, '')
+    config['Outbox'] = {'chat_rate': '1000000', 'chat_burst': '1000',
+                        'global_rate': '1000000'}
+    with open(os.path.join(directory, 'settings.ini'), 'w') as f:
+        config.write(f)
+
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+class Bench:
+    """
+    Runs the scenarios for a number of users and collects the samples.
+
+    Statements are attributed to the scenario by thread: those run by the
+    handler itself, and those run meanwhile by the card queue worker.
+    """
+    def __init__(self, bm, engine, telegram):
+        self.bm = bm
+        self.telegram = telegram
+        self.updates = Updates()
+        self.handler_thread = threading.get_ident()
+        self.sql = 0
+        self.background_sql = 0
+        self.results = {name: {'ms': [], 'sql': [], 'background_sql': [],
+                               'api_calls': [], 'peak_kib': None}
+                        for name in SCENARIOS}
+        event.listen(engine, 'before_cursor_execute', self.count_statement)
+
+    def count_statement(self, *args):
+        if threading.get_ident() == self.handler_thread:
+            self.sql += 1
+        else:
+            self.background_sql += 1
+
+    def send(self, user_id, text = None, data = None):
+        if data is None:
+            update = self.updates.message(user_id, text)
+        else:
+            update = self.updates.callback(user_id, data)
+        self.bm.bot.process_new_updates([update])
+
+    def measure(self, name, run, traced = False):
+        self.bm.outbox.join(10)
+        sql, background_sql = self.sql, self.background_sql
+        calls = len(self.telegram.calls)
+        if traced:
+            tracemalloc.start()
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.results[name]['peak_kib'] = round(peak / 1024, 1)
+            return
+        self.bm.outbox.join(10)
+        result = self.results[name]
+        result['ms'].append(elapsed * 1000)
+        result['sql'].append(self.sql - sql)
+        result['background_sql'].append(self.background_sql -
+                                        background_sql)
+        result['api_calls'].append(len(self.telegram.calls) - calls)
+
+    def scenarios(self, user_id, round_number):
+        bm = self.bm
+        lesson = bm.lessons.get(user_id, user_id)
+        ru_word = f'слово{round_number}x{user_id}'
+        en_word = f'word{round_number}x{user_id}'
+        yield 'next_word', lambda: self.send(user_id, bm.Command.NEXT_WORD)
+        yield 'answer', lambda: self.send(user_id, lesson.card.answer)
+        yield 'add', lambda: (self.send(user_id, bm.Command.ADD_WORD),
+                              self.send(user_id, ru_word),
+                              self.send(user_id, en_word))
+        yield 'delete', lambda: (self.send(user_id, bm.Command.DELETE_WORD),
+                                 self.send(user_id, ru_word))
+        yield 'reset', lambda: (self.send(user_id, '/reset_progress'),
+                                self.send(user_id, data = 'confirm'))
+
+    def run(self, users, rounds):
+        user_ids = range(1000, 1000 + users)
+        for user_id in user_ids:
+            self.measure('start', lambda: self.send(user_id, '/start'))
+            self.send(user_id, data = 'ru_en_direction')
+            self.send(user_id, data = 'my_words')
+        for round_number in range(rounds):
+            for user_id in user_ids:
+                for name, run in self.scenarios(user_id, round_number):
+                    self.measure(name, run)
+        # Memory is traced in a separate pass, tracing slows the handlers.
+        traced_user = 1000 + users
+        self.measure('start', lambda: self.send(traced_user, '/start'),
+                     traced = True)
+        self.send(traced_user, data = 'ru_en_direction')
+        self.send(traced_user, data = 'my_words')
+        for name, run in self.scenarios(traced_user, rounds):
+            self.measure(name, run, traced = True)
+        self.bm.outbox.join(10)
+
+    def summary(self):
+        summary = {}
+        for name, result in self.results.items():
+            if not result['ms']:
+                continue
+            summary[name] = {
+                'samples': len(result['ms']),
+                'p50_ms': round(percentile(result['ms'], 0.5), 3),
+                'p99_ms': round(percentile(result['ms'], 0.99), 3),
+                'mean_ms': round(statistics.fmean(result['ms']), 3),
+                'sql_per_op': round(statistics.fmean(result['sql']), 2),
+                'background_sql_per_op': round(
+                    statistics.fmean(result['background_sql']), 2),
+                'api_calls_per_op': round(
+                    statistics.fmean(result['api_calls']), 2),
+                'peak_kib': result['peak_kib'],
+            }
+        return summary
+
+
+def run(dsn, words, users, rounds):
+    telegram = FakeTelegram()
+    apihelper.CUSTOM_REQUEST_SENDER = telegram
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix = 'bench_handlers_') as directory:
+        files = os.path.join(directory, 'files')
+        os.mkdir(files)
+        os.replace(write_seed_file(directory, words),
+                   os.path.join(files, 'base_dict.json'))
+        write_settings(directory)
+        # bot_manager reads settings.ini and the base dictionary from the
+        # working directory.
+        os.chdir(directory)
+        engine = sqlalchemy.create_engine(
+            dsn or f'sqlite:///{directory}/bench.db')
+        try:
+            import app
+            import bot_manager as bm
+            import migrations
+            from models import Base
+            app.create_app(engine)
+            bm.bot.threaded = False
+            bench = Bench(bm, engine, telegram)
+            bench.run(users, rounds)
+            return bench.summary()
+        finally:
+            os.chdir(cwd)
+            if dsn:
+                Base.metadata.drop_all(engine)
+                migrations.schema_version.drop(engine, checkfirst = True)
+            engine.dispose()
+
+
+def print_summary(summary, baseline = None):
+    print(f'{"scenario":<10}{"p50, ms":>10}{"p99, ms":>10}{"sql/op":>8}'
+          f'{"bg sql":>8}{"api/op":>8}{"peak KiB":>10}')
+    for name, stats in summary.items():
+        line = (f'{name:<10}{stats["p50_ms"]:>10}{stats["p99_ms"]:>10}'
+                f'{stats["sql_per_op"]:>8}{stats["background_sql_per_op"]:>8}'
+                f'{stats["api_calls_per_op"]:>8}{stats["peak_kib"]!s:>10}')
+        previous = (baseline or {}).get(name)
+        if previous and previous['p50_ms']:
+            change = stats['p50_ms'] / previous['p50_ms'] * 100 - 100
+            line += f'  p50 {change:+.1f}%'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--dsn', help = 'database URL of a throwaway '
+                                        'database (default: temporary SQLite)')
+    parser.add_argument('--words', type = int, default = 1000)
+    parser.add_argument('--users', type = int, default = 20)
+    parser.add_argument('--rounds', type = int, default = 5)
+    parser.add_argument('--output', help = 'write the results to this file')
+    parser.add_argument('--baseline', help = 'results of an earlier run to '
+                                             'compare with')
+    args = parser.parse_args()
+    sys.path.insert(0, PROJECT_DIR)
+    summary = run(args.dsn, args.words, args.users, args.rounds)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding = 'utf-8') as f:
+            baseline = json.load(f)['scenarios']
+    print_summary(summary, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf-8') as f:
+            json.dump({'words': args.words, 'users': args.users,
+                       'rounds': args.rounds, 'dsn': bool(args.dsn),
+                       'scenarios': summary}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares building keyboards on every update with the cached, pre-serialized
+markups from keyboards.py.
+
+Usage (from the project root):
+    python -m benchmarks.bench_keyboards [--number 20000]
+
+For each keyboard it prints the CPU time per call and the peak memory
+allocated by a single call.
+"""
+import argparse
+import random
+import timeit
+import tracemalloc
+
+import keyboards
+from lesson_state import StudyCard
+
+ANSWERS = ['apple', 'orange', 'pear', 'banana']
+
+
+CARD = StudyCard(ANSWERS[0], ANSWERS[0], ANSWERS[1:], 1, 1,
+                 'ru_en_direction')
+
+
+def rebuild_translation_menu():
+    answers = list(ANSWERS)
+    random.shuffle(answers)
+    return keyboards._build_translation_menu(answers)
+
+
+def cached_translation_menu():
+    return keyboards.get_translation_menu(CARD)
+
+
+CASES = [
+    ('start menu', keyboards.get_start_menu.__wrapped__,
+     keyboards.get_start_menu),
+    ('select dictionary menu', keyboards.get_select_dict_menu.__wrapped__,
+     keyboards.get_select_dict_menu),
+    ('confirmation keyboard',
+     keyboards.create_confirmation_keyboard.__wrapped__,
+     keyboards.create_confirmation_keyboard),
+    ('saving keyboard', keyboards.create_saving_keyboard.__wrapped__,
+     keyboards.create_saving_keyboard),
+    ('quiz keyboard', rebuild_translation_menu, cached_translation_menu),
+]
+
+
+def peak_allocation(function):
+    function()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--number', type = int, default = 20000)
+    args = parser.parse_args()
+    print(f'{"keyboard":<24}{"rebuilt, us":>13}{"cached, us":>12}'
+          f'{"rebuilt, B":>12}{"cached, B":>11}')
+    for name, rebuilt, cached in CASES:
+        rebuilt_time = timeit.timeit(rebuilt, number = args.number)
+        cached_time = timeit.timeit(cached, number = args.number)
+        print(f'{name:<24}'
+              f'{rebuilt_time / args.number * 1e6:>13.2f}'
+              f'{cached_time / args.number * 1e6:>12.2f}'
+              f'{peak_allocation(rebuilt):>12}'
+              f'{peak_allocation(cached):>11}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Measures the database part of /start (seeding the base dictionary) for
+dictionaries of different sizes.
+
+Usage (from the project root):
+    python -m benchmarks.bench_start [--dsn DSN] [--sizes 25 1000 50000]
+
+By default a throwaway SQLite database is created in a temporary directory.
+A PostgreSQL DSN can be passed instead; the tables are created before and
+dropped after each run, so only point it at an empty test database.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import event
+
+import db_manager as dbm
+from models import Base
+
+RU_LETTERS = 'абвгдежзийклмнопрстуфхцчшщъыьэюя'
+EN_LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def spell(number, letters, length = 4):
+    chars = []
+    for _ in range(length):
+        number, index = divmod(number, len(letters))
+        chars.append(letters[index])
+    return ''.join(chars)
+
+
+def write_seed_file(directory, size):
+    path = os.path.join(directory, f'seed_{size}.json')
+    data = [{'model': 'Word',
+             'fields': {'ru_word': spell(i, RU_LETTERS),
+                        'en_word': spell(i, EN_LETTERS)}}
+            for i in range(size)]
+    with open(path, 'w', encoding = 'utf-8') as f:
+        json.dump(data, f, ensure_ascii = False)
+    return path
+
+
+def timed_start(engine, path, user_name, counter):
+    session = dbm.create_session(engine)
+    counter['statements'] = 0
+    started = time.perf_counter()
+    inserted, skipped = dbm.download_data_from_json(session, path, user_name)
+    elapsed = time.perf_counter() - started
+    session.close()
+    return {'ms': round(elapsed * 1000, 2),
+            'statements': counter['statements'],
+            'inserted': inserted,
+            'skipped': skipped}
+
+
+def run(dsn, size, directory):
+    engine = sqlalchemy.create_engine(dsn)
+    counter = {'statements': 0}
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(*args):
+        counter['statements'] += 1
+
+    Base.metadata.create_all(engine)
+    try:
+        path = write_seed_file(directory, size)
+        return {
+            'size': size,
+            'first_user': timed_start(engine, path, 1, counter),
+            'second_user': timed_start(engine, path, 2, counter),
+            'repeated_start': timed_start(engine, path, 1, counter),
+        }
+    finally:
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--dsn', help = 'database URL of a throwaway '
+                                        'database (default: temporary SQLite)')
+    parser.add_argument('--sizes', type = int, nargs = '+',
+                        default = [25, 1000, 50000])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            dsn = args.dsn or f'sqlite:///{directory}/bench_{size}.db'
+            result = run(dsn, size, directory)
+            for scenario in ('first_user', 'second_user', 'repeated_start'):
+                stats = result[scenario]
+                print(f'{size:>6} words  {scenario:<15} {stats["ms"]:>10} ms  '
+                      f'{stats["statements"]:>4} statements  '
+                      f'inserted {stats["inserted"]}, '
+                      f'skipped {stats["skipped"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,586 +1,214 @@
+import functools
 import logging
-import re
-from sqlalchemy.exc import IntegrityError
 import db_manager as dbm
-import configparser
-import random
+import handlers
+import requests
 import telebot
-from telebot import types, TeleBot, State
-from telebot.handler_backends import State, StatesGroup
+import vocabulary_import
+from card_queue import CardQueue
+from handlers import (config, TOKEN, ADMINS, IMPORT_TIMEOUT, query_monitor,
+                      update_metrics, update_label, lessons, AddWordStates)
+from outbox import Outbox
+from text_dispatch import TextDispatcher
+from keyboards import Command
+from telebot import apihelper
 from telebot.storage import StateMemoryStorage
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
-from psycopg2.errors import  UniqueViolation
-from models import (RussianWord, EnglishWord, RussianEnglishAssociation,
-                    LearnedWord, User)
 
 logging.basicConfig(level = logging.INFO)
 logger = logging.getLogger(__name__)
 
-config = configparser.ConfigParser()
-config.read('settings.ini')
-TOKEN = config['Tokens']['TOKEN']
-
 state_storage = StateMemoryStorage()
-bot = telebot.TeleBot(TOKEN, state_storage = state_storage)
-
-engine = dbm.create_engine()
-session = dbm.create_session(engine)
-
-class Command:
-    ADD_WORD = 'Добавить слово ➕'
-    DELETE_WORD = 'Удалить слово ➖'
-    NEXT_WORD = 'Следующее слово ⏩'
-    BACK = 'Назад ↩️'
-    END = 'Закончить урок ❌'
-
-class Labels:
-    START_LABEL = 'Начинаем!🆕\nВыбери направление перевода:'
-    NEXT_ACTION = 'Выберите следующее действие'
-    CORRECT_PHRASES = [
-        'Отлично! Правильный выбор!',
-        'Молодец! Верный перевод!',
-        'Правильно! Так держать!',
-        'Великолепно! Правильный ответ!'
-    ]
-    INCORRECT_PHRASES = [
-        'Упс! Это не верный ответ.',
-        'Мимо! Попробуй еще раз.',
-        'Неправильный выбор! Попробуй снова.',
-        'Не верно, но не сдавайся!'
-    ]
-class Stickers:
-    CORRECT_STICKERS = [
-        'CAACAgIAAxkBAAOHZ5k4onMUtuHVOYBD3UiLkbCSHn8AAiQBAALjUDAAASluN3-18mMfNgQ',
-        'CAACAgIAAxkBAAOJZ5k4t99ri2kwD_qKHBup-dA80r8AAv8BAALjUDAAAbVxFB9Px_LeNgQ',
-        'CAACAgIAAxkBAAOXZ5k5PEUz2R2lY-R9QmhA48JF5UEAAoAAA-NQMAABK6GZtBHF6Lk2BA',
-        'CAACAgIAAxkBAAOfZ5k5lTkt3d1ZoUHtHVCP_t9DVhAAAqgAA-NQMAABw2dpf7fTyyI2BA',
-        'CAACAgIAAxkBAAOZZ5k5Yu6SqMKH5BVHhJHwO66J6BoAAooAA-NQMAABpkmqNqEkawY2BA',
-        'CAACAgIAAxkBAAOVZ5k5IgYQPubxU0bbaNVPt4wZ7JMAAq4AA-NQMAABDSgLIWw_6EM2BA'
-    ]
-
-    INCORRECT_STICKERS = [
-        'CAACAgIAAxkBAAODZ5k4hYw4hcN_mZoX5W_juUhmLR4AAqAAA-NQMAAB0QmXSwAB_JB9NgQ',
-        'CAACAgIAAxkBAAOFZ5k4nK89SqYIKLJJUVwn7w0J_bEAAv4BAALjUDAAAZ_RW1koLZOGNgQ',
-        'CAACAgIAAxkBAAOLZ5k40dwD52m58T9TpJotw7NBL0wAAoQAA-NQMAAB8kVi1X7e_EU2BA',
-        'CAACAgIAAxkBAAONZ5k41KgHCPM4RFiQOuhvseKtHXMAAiYBAALjUDAAAZOQPN3l-K2NNgQ',
-        'CAACAgIAAxkBAAORZ5k482VmBf6Ek0bwCeF1uCKwJjgAAogAA-NQMAAB_e0dxxhg7Sw2BA',
-        'CAACAgIAAxkBAAOTZ5k49x1XvKVZ-nw594SG6rcWPX0AAowAA-NQMAABKw9NhY2lc7M2BA',
-        'CAACAgIAAxkBAAObZ5k5eQfTo1qvYDAeGxpjY-Z-F0EAAoYAA-NQMAABwC775648wRs2BA',
-        'CAACAgIAAxkBAAOdZ5k5h3WQGXVcARMKMHuA9C0uvMAAAqIAA-NQMAABwkLo4ETW2wo2BA'
-    ]
-class SessionDataSet():
-    current_word = ''
-    target_word = ''
-    other_words = []
-    used_words = []
-    translate_direction = ''
-    learned_ru_word_id = None
-    learned_en_word_id = None
-    dict_type = ''
-    correct_answers = []
-    current_word_attempts = 0
-
-
-class AddWordStates(StatesGroup):
-    russian_added_word = State()
-    english_added_word = State()
-
-class DeleteWordStates(StatesGroup):
-    deleted_word = State()
-
-
-def get_start_menu():
-    markup = types.InlineKeyboardMarkup(row_width = 2)
-    en_ru_btn = types.InlineKeyboardButton('EN ➡️ RU', callback_data =
-    'en_ru_direction')
-    ru_en_btn = types.InlineKeyboardButton('RU ➡️ EN', callback_data =
-    'ru_en_direction')
-    return markup.add(en_ru_btn, ru_en_btn)
-
-def get_select_dict_menu():
-    markup = types.InlineKeyboardMarkup(row_width = 3)
-    base_dict = types.InlineKeyboardButton('Все слова 📚',
-                                           callback_data = 'all_words')
-    user_dict = types.InlineKeyboardButton('Мои слова 📖',
-                                           callback_data = 'my_words')
-    backstate_btn = types.InlineKeyboardButton(Command.BACK,
-                                         callback_data = 'go_back_direction')
-    return markup.add(base_dict, user_dict, backstate_btn)
-
-def get_translation_menu():
-    markup = types.ReplyKeyboardMarkup(row_width = 2)
-    target_word_btn = types.KeyboardButton(SessionDataSet.target_word)
-    other_word_btns = [types.KeyboardButton(word) for word in
-                       SessionDataSet.other_words]
-    buttons = [target_word_btn] + other_word_btns
-    random.shuffle(buttons)
-    next_word_btn = types.KeyboardButton(Command.NEXT_WORD)
-    delete_word_btn = types.KeyboardButton(Command.DELETE_WORD)
-    add_word_btn = types.KeyboardButton(Command.ADD_WORD)
-    close_btn = types.InlineKeyboardButton(Command.END)
-    buttons.extend([add_word_btn, delete_word_btn, next_word_btn, close_btn])
-    return markup.add(*buttons)
-
-def create_confirmation_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.row(
-        InlineKeyboardButton('Да', callback_data = 'confirm'),
-              InlineKeyboardButton('Нет', callback_data = 'cancel')
-    )
-    return keyboard
-
-def create_saving_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.row(
-        InlineKeyboardButton('Сохранить', callback_data = 'save'),
-              InlineKeyboardButton('Отменить', callback_data = 'cancel_save')
-    )
-    return keyboard
-
-def is_russian(text):
-    return bool(re.match('^[а-яА-ЯёЁ]+$', text))
-
-def is_english(text):
-    return bool(re.match('^[a-zA-Z]+$', text))
+bot = telebot.TeleBot(TOKEN, state_storage = state_storage,
+                      num_threads = config.getint('Bot', 'num_threads',
+                                                  fallback = 4))
+
+outbox = Outbox(
+    bot,
+    chat_rate = config.getfloat('Outbox', 'chat_rate', fallback = 1.0),
+    chat_burst = config.getint('Outbox', 'chat_burst', fallback = 3),
+    global_rate = config.getfloat('Outbox', 'global_rate', fallback = 30.0),
+    workers = config.getint('Outbox', 'workers', fallback = 4),
+    max_retries = config.getint('Outbox', 'max_retries', fallback = 3)
+)
+
+# The engine is bound to the session by app.create_app.
+session = dbm.Session
+
+
+def per_update(handler):
+    @functools.wraps(handler)
+    def wrapper(update, *args, **kwargs):
+        with (update_metrics.track(handler.__name__, update_label(update)),
+              query_monitor.track(handler.__name__), dbm.session_scope()):
+            return handler(update, *args, **kwargs)
+    return wrapper
+
+def load_study_cards(user_name, dictionary_type, translate_direction, count):
+    with dbm.session_scope() as worker_session:
+        return dbm.get_study_cards(dictionary_type, translate_direction,
+                                   user_name, worker_session, count)
+
+card_queue = CardQueue(load_study_cards, ttl = lessons.ttl,
+                       max_keys = lessons.max_states)
+
+text_dispatcher = TextDispatcher(handlers.get_answer_options)
+update_metrics.add_source('text_dispatch_messages', text_dispatcher.stats,
+                          label = 'handler')
+
+
+def deliver(replies, chat_id, message_id = None, call_id = None):
+    # Callback queries are answered at once, everything else goes through
+    # the outbox in order.
+    for reply in replies:
+        if reply.method == 'answer_callback_query':
+            bot.answer_callback_query(call_id, reply.content,
+                                      **reply.options)
+        elif reply.method == 'edit_message_text':
+            outbox.edit_message_text(reply.content, chat_id, message_id,
+                                     **reply.options)
+        else:
+            getattr(outbox, reply.method)(chat_id, reply.content,
+                                          **reply.options)
 
 @bot.message_handler(commands = ['start'])
+@per_update
 def start_command(message):
-    bot.send_message(message.chat.id, Labels.START_LABEL,
-                     reply_markup = get_start_menu())
-    user_name = message.from_user.id
-    dbm.download_data_from_json(session = session,
-                                path='files/base_dict.json',
-                                user_name = user_name)
+    deliver(handlers.start_replies(), message.chat.id)
+    handlers.start(session, message.from_user.id)
 
 @bot.callback_query_handler(func = lambda call:True)
+@per_update
 def callback_all_commands(call):
     if not call.message:
         return
     chat_id = call.message.chat.id
-    message_id = call.message.message_id
-    user_id = call.from_user.id
-    if call.data in ['en_ru_direction', 'ru_en_direction']:
-        SessionDataSet.translate_direction = call.data
-        direction = 'EN ➡️ RU' if call.data == 'en_ru_direction' else 'RU ➡️ EN'
-        text = f'Вы выбрали {direction} перевод.\nВыберите словарь для изучения:'
-        bot.edit_message_text(chat_id = chat_id, message_id = message_id,
-                              text = text,
-                              reply_markup = get_select_dict_menu())
-    elif call.data == 'go_back_direction':
-        bot.edit_message_text(chat_id = chat_id, message_id = message_id,
-                              text = Labels.START_LABEL,
-                              reply_markup = get_start_menu())
-    elif call.data in ['all_words', 'my_words']:
-        SessionDataSet.dict_type = call.data
-        word_list = dbm.get_word_for_study(call.data,
-                                           SessionDataSet.translate_direction,
-                                           user_id, session)
-        if len(word_list) < 5:
-            notification = ('Недостаточно слов в словаре. Пожалуйста, '
-                            'добавьте больше слов для изучения или сбросьте '
-                            'прогресс изучения используя команду '
-                            '/reset_progress')
-            bot.answer_callback_query(call.id, text = notification,
-                                      show_alert = True)
-            return
-        (SessionDataSet.current_word, SessionDataSet.target_word,
-         *SessionDataSet.other_words) = word_list
-        SessionDataSet.used_words.append(SessionDataSet.current_word)
-        is_en_ru = SessionDataSet.translate_direction == 'en_ru_direction'
-        header_text = (f'{'Translate word' if is_en_ru else 'Переведи слово'} :\n'
-                       f'👉{SessionDataSet.current_word}👈')
-        task_text = f'{'Choose a translation option' if is_en_ru else 
-                       'Выбери вариант перевода'}:'
-        bot.edit_message_text(chat_id = chat_id, message_id = message_id,
-                              text = header_text)
-        bot.send_message(chat_id, text = task_text,
-                         reply_markup = get_translation_menu())
-
-    if call.data == 'confirm':
-        clear_choice_btn()
-        success, message_text = reset_users_progress(call.from_user.id,
-                                                     session)
-        bot.answer_callback_query(call.id, text = message_text)
-        bot.edit_message_text(
-            chat_id = call.message.chat.id,
-            message_id = call.message.message_id,
-            text = message_text
-        )
-        if success:
-            bot.send_message(call.message.chat.id,
-                             text = Labels.NEXT_ACTION,
-                             reply_markup = get_translation_menu())
-    elif call.data == 'cancel':
-        clear_choice_btn()
-        bot.answer_callback_query(call.id,
-                                  text = 'Сброс прогресса отменен!')
-        bot.edit_message_text(
-            chat_id = call.message.chat.id,
-            message_id = call.message.message_id,
-            text = 'Сброс прогресса отменен.'
-        )
-        bot.send_message(call.message.chat.id,
-                         text = Labels.NEXT_ACTION,
-                         reply_markup = get_translation_menu())
-    if call.data == 'save':
-        clear_choice_btn()
-        message_text = (f'Слово успешно сохранено в изученных!\n'
-                        f'{Labels.NEXT_ACTION}')
-        bot.answer_callback_query(call.id)
-        bot.edit_message_text(
-            chat_id = call.message.chat.id,
-            message_id = call.message.message_id,
-            text = 'Выполняем сохранение!'
-        )
-        user_id = dbm.get_user_id(session, call.from_user.id)
-        new_learned_word = dbm.mark_word_as_learned(
-            russian_word_id=SessionDataSet.learned_ru_word_id,
-            english_word_id=SessionDataSet.learned_en_word_id,
-            user_id = user_id ,
-            session = session)
-        if new_learned_word:
-            bot.send_message(call.message.chat.id,
-                             message_text,
-                             reply_markup = get_translation_menu())
-        else:
-            bot.send_message(call.message.chat.id,
-                             'Ошибка сохранения!',
-                             reply_markup = get_translation_menu())
-    elif call.data == 'cancel_save':
-        clear_choice_btn()
-        bot.answer_callback_query(call.id)
-        bot.edit_message_text(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text='Сохранение отменено!')
-        bot.send_message(call.message.chat.id,
-                         text = Labels.NEXT_ACTION,
-                         reply_markup = get_translation_menu())
-
-    if call.data == 'new_lesson':
-        bot.edit_message_text(chat_id = chat_id, message_id = message_id,
-                              text = 'Выберите направление перевода для '
-                                     'нового урока:',
-                              reply_markup = get_start_menu())
-    elif call.data == 'exit':
-        bot.edit_message_text(chat_id = chat_id, message_id = message_id,
-                              text = 'До новых встреч!')
-
-    bot.answer_callback_query(call.id)
-
+    lesson = lessons.get(call.from_user.id, chat_id)
+    deliver(handlers.callback_replies(session, card_queue, call, lesson),
+            chat_id, call.message.message_id, call.id)
 
-def clear_choice_btn():
-    SessionDataSet.current_word = ''
-    SessionDataSet.target_word = ''
-    SessionDataSet.other_words = []
-
-
-@bot.message_handler(func = lambda message: message.text == Command.ADD_WORD)
+@text_dispatcher.command(Command.ADD_WORD)
+@per_update
 def handle_add_word(message):
-    bot.send_message(message.chat.id, 'Введите русское слово:',
-                     reply_markup = ReplyKeyboardRemove())
+    deliver(handlers.add_word_replies(), message.chat.id)
     bot.register_next_step_handler(message, handle_russian_word)
 
+@per_update
 def handle_russian_word(message):
-    russian_word = message.text.lower()
-    bot.set_state(message.from_user.id,
-                  AddWordStates.russian_added_word,
-                  message.chat.id
-                  )
-    # logger.info(f'Received message: {message.text}')
+    bot.set_state(message.from_user.id, AddWordStates.russian_added_word,
+                  message.chat.id)
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
-        data['russian_word'] = russian_word
-        # logger.info(f'Current state data: {data}')
-    bot.send_message(message.chat.id, 'Теперь введите соответствующий '
-                                      'русскому слову английский перевод:')
+        data['russian_word'] = message.text.lower()
+    deliver(handlers.russian_word_replies(), message.chat.id)
     bot.set_state(message.from_user.id, AddWordStates.english_added_word,
                   message.chat.id)
     bot.register_next_step_handler(message, handle_english_word)
-    # logger.info(f'User {message.from_user.id} entered Russian word: '
-    #             f'{russian_word}. Waiting for English translation.')
 
+@per_update
 def handle_english_word(message):
-    english_word = message.text.lower()
+    lesson = lessons.get(message.from_user.id, message.chat.id)
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
         russian_word = data['russian_word']
-    # logger.info(f'User {message.from_user.id} entered English word: '
-    #             f'{english_word}. Waiting for storing words in DB.')
-    if dbm.create_user(message.from_user.id, session):
-        try:
-            ru_word = RussianWord(ru_word = russian_word)
-            en_word = EnglishWord(en_word = english_word)
-            session.add_all([ru_word, en_word])
-            session.flush()
-            # logger.info(f'Created association: {word_association}')
-            user_id = session.query(User.id).filter(
-                User.username == message.from_user.id).first()[0]
-            # user_association = RuWordUserAssociation(russian_word_id = ru_word.id,
-            #                                          user_id = user_id)
-            # # logger.info(f'Created association: {user_association}')
-            word_association = RussianEnglishAssociation(
-                            russian_word_id = ru_word.id,
-                            english_word_id = en_word.id,
-                            user_id = user_id,
-                        )
-            session.add(word_association)
-            session.commit()
-            bot.send_message(message.chat.id,
-                             f'Пара слов {russian_word} - {english_word} '
-                             f'успешно добавлена в словарь.')
-        except IntegrityError as e:
-            session.rollback()
-            if isinstance(e.orig, UniqueViolation):
-
-                bot.send_message(message.chat.id,
-                             f'Пара слов {russian_word} - {english_word} '
-                             f'уже есть в словаре!')
-            else:
-                bot.send_message(message.chat.id,
-                            'Произошла ошибка при добавлении слова в словарь!')
-        finally:
-            bot.delete_state(message.from_user.id, message.chat.id)
-            bot.send_message(message.chat.id, text = Labels.NEXT_ACTION,
-                             reply_markup = get_translation_menu())
-    else:
-        bot.send_message(message.chat.id,
-                         'Произошла ошибка при добавлении пользователя в '
-                         'базу данных!',
-                         reply_markup = get_translation_menu())
-
-@bot.message_handler(func = lambda message:
-                     message.text == Command.DELETE_WORD)
-def handle_delete_word(message):
+    try:
+        deliver(handlers.english_word_replies(
+            session, message.from_user.id, russian_word,
+            message.text.lower(), lesson), message.chat.id)
+    finally:
+        bot.delete_state(message.from_user.id, message.chat.id)
+
+def download_document(file_id):
+    response = requests.get(bot.get_file_url(file_id), stream = True,
+                            timeout = IMPORT_TIMEOUT,
+                            proxies = apihelper.proxy)
+    response.raise_for_status()
+    return response
+
+@bot.message_handler(content_types = ['document'])
+@per_update
+def handle_document(message):
     chat_id = message.chat.id
-    bot.send_message(chat_id, 'Введите слово для удаления '
-                              '(на русском или английском):',
-                              reply_markup = ReplyKeyboardRemove())
+    user_id = message.from_user.id
+    document = message.document
+    lesson = lessons.get(user_id, chat_id)
+    rejection = handlers.document_rejection(document)
+    if rejection:
+        deliver(rejection, chat_id)
+        return
+    deliver(handlers.document_accepted(document), chat_id)
+    progress = handlers.import_progress(
+        lambda text: outbox.send_message(chat_id, text))
+    try:
+        with download_document(document.file_id) as response:
+            pairs, counts = handlers.read_document(
+                response.iter_content(vocabulary_import.READ_SIZE),
+                document.file_name)
+            replies = handlers.import_replies(session, card_queue, user_id,
+                                              pairs, counts, progress)
+    except requests.RequestException:
+        logger.exception('Не удалось скачать файл %s', document.file_name)
+        replies = handlers.download_failed_replies()
+    deliver(replies + handlers.next_action_replies(lesson), chat_id)
+
+@text_dispatcher.command(Command.DELETE_WORD)
+@per_update
+def handle_delete_word(message):
+    deliver(handlers.delete_word_replies(), message.chat.id)
     bot.register_next_step_handler(message, handle_word_to_delete)
 
+@per_update
 def handle_word_to_delete(message):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    word_to_delete = message.text.lower()
-    try:
-        ru_word = session.query(RussianWord).filter(RussianWord.ru_word ==
-                                                    word_to_delete).first()
-        en_word = session.query(EnglishWord).filter(EnglishWord.en_word ==
-                                                    word_to_delete).first()
-        if ru_word:
-            associations = session.query(RussianEnglishAssociation).filter_by(
-                russian_word_id = ru_word.id).all()
-            for items in associations:
-                other_items = session.query(RussianEnglishAssociation).filter(
-                    RussianEnglishAssociation.english_word_id == items.english_word_id,
-                    RussianEnglishAssociation.russian_word_id != ru_word.id
-                ).first()
-                if not other_items:
-                    en_word_to_delete = session.get(EnglishWord,
-                                                    items.english_word_id)
-                    if en_word_to_delete:
-                        session.delete(en_word_to_delete)
-                session.delete(items)
-            session.delete(ru_word)
-            session.commit()
-            bot.send_message(chat_id,
-                             f'Слово - {word_to_delete} - и его уникальные '
-                             f'переводы удалены из словаря.')
-        elif en_word:
-            associations = session.query(RussianEnglishAssociation).filter_by(
-                english_word_id = en_word.id).all()
-            for items in associations:
-                other_items = session.query(RussianEnglishAssociation).filter(
-                    RussianEnglishAssociation.russian_word_id == items.russian_word_id,
-                    RussianEnglishAssociation.english_word_id != en_word.id
-                ).first()
-                if not other_items:
-                    ru_word_to_delete = session.get(RussianWord,
-                                                    items.russian_word_id)
-                    if ru_word_to_delete:
-                        session.delete(ru_word_to_delete)
-                session.delete(items)
-            session.delete(en_word)
-            session.commit()
-            bot.send_message(chat_id,
-                             f'Слово - {word_to_delete} - и его уникальные '
-                             f'переводы удалены из словаря.')
-        else:
-            bot.send_message(chat_id, f'Слово - {word_to_delete} - '
-                                      f'не найдено в словаре.')
-    except Exception as e:
-        session.rollback()
-        bot.send_message(chat_id, 'Произошла ошибка при удалении слова!')
-    finally:
-        bot.send_message(chat_id, text = Labels.NEXT_ACTION,
-                         reply_markup = get_translation_menu())
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    deliver(handlers.word_to_delete_replies(
+        session, card_queue, message.from_user.id, message.text.lower(),
+        lesson), message.chat.id)
 
 @bot.message_handler(commands = ['reset_progress'])
+@per_update
 def handle_reset_progress(message):
-    user_name = message.from_user.id
-    bot.send_message(message.chat.id,
-                     'Вы уверены, что хотите сбросить весь прогресс обучения? '
-                     'Это действие нельзя отменить!',
-                     reply_markup=ReplyKeyboardRemove())
-    bot.send_message(message.chat.id,
-                'Подтвердите выбор!',
-                     reply_markup = create_confirmation_keyboard())
+    deliver(handlers.reset_progress_replies(), message.chat.id)
 
-def reset_users_progress(user_id, session):
-    try:
-        user = session.query(User).filter(User.username == user_id).first()
-        if not user:
-            return False, 'Пользователь не найден!'
-        deleted = session.query(LearnedWord).filter(
-            LearnedWord.user_id == user.id).delete()
-        session.commit()
-        return True, f'Прогресс сброшен. Удалено {deleted} выученных слов(а)!'
-    except Exception as e:
-        session.rollback()
-        return False, f'Произошла ошибка при сбросе прогресса: {str(e)}'
+@bot.message_handler(commands = ['export'])
+@per_update
+def handle_export(message):
+    file_format, user_name = handlers.export_arguments(message)
+    deliver(handlers.export_replies(session, user_name, file_format),
+            message.chat.id)
 
-@bot.message_handler(func = lambda message: message.text in [
-    SessionDataSet.target_word] + SessionDataSet.other_words)
+@text_dispatcher.answer
+@per_update
 def handle_translation_choice(message):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    chosen_word = message.text
-    if SessionDataSet.translate_direction == 'ru_en_direction':
-        SessionDataSet.learned_ru_word_id = dbm.get_russian_word_id(
-            session, SessionDataSet.current_word)
-        SessionDataSet.learned_en_word_id = dbm.get_english_word_id(
-            session, SessionDataSet.target_word)
-    else:
-        SessionDataSet.learned_en_word_id = dbm.get_english_word_id(
-            session, SessionDataSet.current_word)
-        SessionDataSet.learned_ru_word_id = dbm.get_russian_word_id(
-            session, SessionDataSet.target_word)
-    SessionDataSet.current_word_attempts += 1
-    if chosen_word == SessionDataSet.target_word:
-        if SessionDataSet.current_word_attempts == 1:
-            SessionDataSet.correct_answers.append(SessionDataSet.current_word)
-        phrase = random.choice(Labels.CORRECT_PHRASES)
-        sticker_id = random.choice(Stickers.CORRECT_STICKERS)
-        bot.send_message(chat_id, phrase)
-        bot.send_sticker(chat_id, sticker_id)
-        bot.send_message(message.chat.id,
-                         'Сохранить слово в изученных?',
-                         reply_markup = create_saving_keyboard())
-        SessionDataSet.current_word_attempts = 0
-    else:
-        phrase = random.choice(Labels.INCORRECT_PHRASES)
-        sticker_id = random.choice(Stickers.INCORRECT_STICKERS)
-
-        bot.send_message(chat_id, phrase)
-        bot.send_sticker(chat_id, sticker_id)
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    deliver(handlers.translation_choice_replies(
+        session, card_queue, message.from_user.id, lesson, message.text),
+        message.chat.id)
 
-        if SessionDataSet.translate_direction == 'ru_en_direction':
-            bot.send_message(chat_id,
-                         f'Попробуйте еще раз. Переведите слово '
-                             f'👉{SessionDataSet.current_word}👈')
-        else:
-            bot.send_message(chat_id,
-                             f'Try again. Translate word: '
-                             f'👉{SessionDataSet.current_word}👈')
-
-        if (SessionDataSet.current_word_attempts >= 3 or
-                chosen_word == SessionDataSet.target_word):
-            bot.send_message(chat_id,
-                             'Вы использовали все попытки!\nПереходим к '
-                             'следующему слову!')
-            SessionDataSet.current_word_attempts = 0
-            handle_next_word(message)
-
-@bot.message_handler(func = lambda message:
-                     message.text == Command.NEXT_WORD)
+@text_dispatcher.command(Command.NEXT_WORD)
+@per_update
 def handle_next_word(message):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    word_list = dbm.get_word_for_study(
-        SessionDataSet.dict_type,
-        SessionDataSet.translate_direction,
-        user_id,
-        session
-    )
-    if len(word_list) < 5:
-        bot.send_message(chat_id,
-                         'Недостаточно слов в словаре. Пожалуйста, '
-                         'добавьте больше слов для изучения или сбросьте '
-                         'прогресс изучения используя команду /reset_progress')
-        return
-
-    (SessionDataSet.current_word, SessionDataSet.target_word,
-     *SessionDataSet.other_words) = word_list
-    SessionDataSet.used_words.append(SessionDataSet.current_word)
-
-    is_en_ru = SessionDataSet.translate_direction == 'en_ru_direction'
-    header_text = (f'{'Translate word:' if is_en_ru else 'Переведи слово'}:\n'
-                   f'👉{SessionDataSet.current_word}👈')
-    task_text = f'{'Choose a translation option' if is_en_ru else 
-                 'Выбери вариант перевода'}:'
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    deliver(handlers.next_word_replies(session, card_queue,
+                                       message.from_user.id, lesson),
+            message.chat.id)
 
-    bot.send_message(chat_id = chat_id, text = header_text)
-    bot.send_message(chat_id = chat_id, text = task_text,
-                     reply_markup=get_translation_menu())
-
-@bot.message_handler(func = lambda message: message.text == Command.END)
+@text_dispatcher.command(Command.END)
+@per_update
 def handle_end_lesson(message):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    total_words = len(SessionDataSet.used_words)
-    correct_answers = sum(1 for word in SessionDataSet.used_words if word in
-                          SessionDataSet.correct_answers)
-    accuracy = (correct_answers / total_words) * 100 if total_words > 0 else 0
-    result_text = (
-        f'Урок завершен!\n\n'
-        f'📊 Статистика урока:\n'
-        f'📚 Всего слов изучено: {total_words}\n'
-        f'✅ Правильных ответов: {correct_answers}\n'
-        f'🎯 Точность перевода: {accuracy:.2f}%\n\n'
-        f'Хотите начать новый урок?'
-    )
-    markup = types.InlineKeyboardMarkup(row_width = 2)
-    new_lesson_btn = types.InlineKeyboardButton('Новый урок',
-                                                callback_data = 'new_lesson')
-    exit_btn = types.InlineKeyboardButton('Пока! 👋',
-                                               callback_data = 'exit')
-
-    markup.add(new_lesson_btn, exit_btn)
-    bot.send_message(chat_id, result_text, reply_markup =
-                     ReplyKeyboardRemove())
-    bot.send_message(chat_id, Labels.NEXT_ACTION, reply_markup = markup)
-
-    SessionDataSet.used_words.clear()
-    SessionDataSet.correct_answers.clear()
-    SessionDataSet.current_word = ''
-    SessionDataSet.target_word = ''
-    SessionDataSet.other_words.clear()
+    lesson = lessons.get(message.from_user.id, message.chat.id)
+    deliver(handlers.end_lesson_replies(lesson), message.chat.id)
 
 @bot.message_handler(commands = ['help'])
+@per_update
 def help_command(message):
-    help_text = (
-        '🤖 Инструкция по работе с ботом:\n\n'
-        '1️⃣ Начало работы:\n'
-        '   • Используйте команду /start для начала работы\n'
-        '   • Выберите направление перевода (EN ➡️ RU или RU ➡️ EN)\n'
-        '   • Выберите словарь для изучения:\n'
-        '   • \'Все слова 📚\' - общий словарь всех пользователей бота\n'
-        '   • \'Мои слова 📖\' - словарь текущего пользователя\n\n'
-        '2️⃣ Изучение слов:\n'
-        '   • Бот будет показывать слова для перевода\n'
-        '   • Выберите правильный вариант перевода из предложенных\n'
-        '   • Используйте кнопку \'Следующее слово ⏩\' для перехода к '
-        'следующему слову\n\n'
-        '3️⃣ Управление словарем:\n'
-        '   • \'Добавить слово ➕\':  добавление новой пары слов в словарь\n'
-        '   • \'Удалить слово ➖\':  удаление пары слов из словаря\n\n'
-        '4️⃣ Завершение урока:\n'
-        '   • Нажмите \'Закончить урок ❌\' для просмотра статистики и '
-        'завершения работы со словарем\n\n'
-        '5️⃣ Дополнительные команды:\n'
-        '   • /reset_progress - сброс прогресса изучения\n‼️ Внимание! '
-        'Сброс прогресса отменить нельзя!!\n\n'
-        'Удачи в изучении языка! 🌟'
-    )
-    bot.send_message(message.chat.id, help_text)
+    deliver(handlers.help_replies(), message.chat.id)
+
+@bot.message_handler(commands = ['metrics_dump'],
+                     func = lambda message: message.from_user.id in ADMINS)
+@per_update
+def metrics_dump(message):
+    deliver(handlers.metrics_replies(), message.chat.id)
+
+# Registered last, so that the command handlers above are tried first.
+bot.register_message_handler(text_dispatcher.dispatch,
+                             content_types = ['text'])
 
 # @bot.message_handler(func = lambda message: True, content_types = ['text'])
 # def handle_all_messages(message):
@@ -0,0 +1,153 @@
+import random
+import threading
+from array import array
+from collections import OrderedDict
+
+ID_CACHE_SIZE = 50000
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe mapping that evicts the least recently used key.
+
+    Used to keep hot lookups (usernames and words to their database ids)
+    in process memory, so repeated requests do not reach the database.
+
+    Attributes:
+        max_size (int): The maximum number of keys kept in the cache.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that were not in the cache.
+    """
+    def __init__(self, max_size = ID_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last = False)
+
+    def update(self, mapping):
+        for key, value in mapping.items():
+            self.put(key, value)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+user_ids = LRUCache()
+russian_word_ids = LRUCache()
+english_word_ids = LRUCache()
+
+
+class WordPool:
+    """
+    A compact in-memory copy of one word table, used to pick distractors.
+
+    Word ids are kept in an array and texts in a parallel list, with a
+    position index so that adding, removing and sampling a word all take
+    constant time regardless of the dictionary size.
+
+    Attributes:
+        loaded (bool): Whether the pool has been filled from the database.
+    """
+    def __init__(self):
+        self.loaded = False
+        self._ids = array('q')
+        self._texts = []
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def load(self, rows):
+        with self._lock:
+            self._ids = array('q')
+            self._texts = []
+            self._positions = {}
+            for word_id, text in rows:
+                self._append(word_id, text)
+            self.loaded = True
+
+    def _append(self, word_id, text):
+        if word_id in self._positions:
+            return
+        self._positions[word_id] = len(self._ids)
+        self._ids.append(word_id)
+        self._texts.append(text)
+
+    def add(self, word_id, text):
+        with self._lock:
+            if self.loaded:
+                self._append(word_id, text)
+
+    def remove(self, word_id):
+        with self._lock:
+            position = self._positions.pop(word_id, None)
+            if position is None:
+                return
+            last_id = self._ids.pop()
+            last_text = self._texts.pop()
+            if last_id != word_id:
+                self._ids[position] = last_id
+                self._texts[position] = last_text
+                self._positions[last_id] = position
+
+    def sample(self, count, exclude_ids = ()):
+        with self._lock:
+            size = len(self._ids)
+            available = size - sum(1 for word_id in exclude_ids
+                                   if word_id in self._positions)
+            count = min(count, available)
+            picked = {}
+            attempts = 0
+            while len(picked) < count and attempts < count * 10:
+                attempts += 1
+                position = random.randrange(size)
+                word_id = self._ids[position]
+                if word_id not in exclude_ids and word_id not in picked:
+                    picked[word_id] = self._texts[position]
+            if len(picked) < count:
+                for position in range(size):
+                    word_id = self._ids[position]
+                    if word_id not in exclude_ids and word_id not in picked:
+                        picked[word_id] = self._texts[position]
+                        if len(picked) == count:
+                            break
+            return list(picked.values())
+
+
+russian_words = WordPool()
+english_words = WordPool()
@@ -0,0 +1,202 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+from lesson_state import LESSON_TTL, MAX_LESSONS
+
+logger = logging.getLogger(__name__)
+
+CARD_QUEUE_SIZE = 5
+CARD_QUEUE_LOW_WATER = 2
+
+
+class LearnerCards:
+    """
+    The queued cards of one (user, dictionary type, translate direction).
+
+    Attributes:
+        cards (deque): The cards ready to be shown.
+        shown_pair (tuple): The pair ids of the last card handed out, which
+                            is on the learner's screen and is not queued.
+        touched_at (float): The monotonic time of the last access.
+    """
+    __slots__ = ('cards', 'shown_pair', 'touched_at')
+
+    def __init__(self):
+        self.cards = deque()
+        self.shown_pair = None
+        self.touched_at = time.monotonic()
+
+
+class CardQueue:
+    """
+    Holds the next few quiz cards for every learner, so that answering
+    'Next word' does not have to wait for the database.
+
+    Cards are kept per (user, dictionary type, translate direction) key and
+    are refilled by a background worker when a queue runs low. Cards are
+    lesson_state.StudyCard objects. Like lessons, queues not used for
+    longer than ttl seconds are evicted, and the least recently used ones
+    are dropped once more than max_keys are kept.
+
+    Attributes:
+        load_cards (callable): A function (user_name, dictionary_type,
+                               translate_direction, count) returning up to
+                               count new cards.
+        size (int): The number of cards to keep ready per key.
+        low_water (int): A refill is scheduled when fewer cards remain.
+        ttl (float): Seconds of inactivity after which a queue is evicted.
+        max_keys (int): The maximum number of queues kept in memory.
+    """
+    def __init__(self, load_cards, size = CARD_QUEUE_SIZE,
+                 low_water = CARD_QUEUE_LOW_WATER, ttl = LESSON_TTL,
+                 max_keys = MAX_LESSONS):
+        self.load_cards = load_cards
+        self.size = size
+        self.low_water = low_water
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._queues = OrderedDict()
+        # A refill in flight is accepted only while its marker is here, so
+        # invalidating a user drops the markers of their refills.
+        self._filling = {}
+        self._scheduled = set()
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def __len__(self):
+        return len(self._queues)
+
+    def pop(self, user_name, dictionary_type, translate_direction,
+            load = None):
+        # load() is called for a card when the queue is empty, before the
+        # refill is scheduled, so the refill knows which card is shown.
+        key = (user_name, dictionary_type, translate_direction)
+        with self._lock:
+            learner = self._touch(key)
+            card = learner.cards.popleft() if learner.cards else None
+        if card is None and load is not None:
+            card = load()
+        with self._lock:
+            learner = self._touch(key)
+            if card is not None:
+                learner.shown_pair = card.pair
+            remaining = len(learner.cards)
+        if remaining < self.low_water:
+            self.schedule(key)
+        return card
+
+    def schedule(self, key):
+        with self._lock:
+            if key in self._scheduled:
+                return
+            self._scheduled.add(key)
+            if self._worker is None:
+                self._worker = threading.Thread(target = self._run,
+                                                name = 'card-queue',
+                                                daemon = True)
+                self._worker.start()
+        self._requests.put(key)
+
+    def discard_pair(self, user_name, russian_word_id, english_word_id):
+        with self._lock:
+            self._bump(user_name)
+            for key, learner in self._queues.items():
+                if key[0] != user_name:
+                    continue
+                kept = [card for card in learner.cards
+                        if card.pair != (russian_word_id, english_word_id)]
+                if len(kept) != len(learner.cards):
+                    learner.cards = deque(kept)
+
+    def invalidate(self, user_name = None):
+        with self._lock:
+            if user_name is None:
+                self._filling.clear()
+                self._queues.clear()
+                return
+            self._bump(user_name)
+            for key in list(self._queues):
+                if key[0] == user_name:
+                    del self._queues[key]
+
+    def _touch(self, key):
+        now = time.monotonic()
+        learner = self._queues.get(key)
+        if learner is None:
+            learner = self._queues[key] = LearnerCards()
+        else:
+            self._queues.move_to_end(key)
+        learner.touched_at = now
+        self._evict(now)
+        return learner
+
+    def _evict(self, now):
+        queues = self._queues
+        while queues:
+            key, oldest = next(iter(queues.items()))
+            if (len(queues) <= self.max_keys and
+                    now - oldest.touched_at <= self.ttl):
+                break
+            del queues[key]
+
+    def _bump(self, user_name):
+        for key in [key for key in self._filling if key[0] == user_name]:
+            del self._filling[key]
+
+    def _run(self):
+        while True:
+            key = self._requests.get()
+            try:
+                self._fill(key)
+            except Exception:
+                logger.exception('Не удалось подготовить карточки для %s',
+                                 key)
+            finally:
+                with self._lock:
+                    self._filling.pop(key, None)
+                    self._scheduled.discard(key)
+
+    def _fill(self, key):
+        with self._lock:
+            learner = self._queues.get(key)
+            if learner is None:
+                # Evicted or invalidated since the refill was scheduled.
+                return
+            missing = self.size - len(learner.cards)
+            marker = self._filling[key] = object()
+        if missing <= 0:
+            return
+        # One extra card makes up for the shown one, if it comes back.
+        cards = self.load_cards(*key, missing + 1)
+        with self._lock:
+            learner = self._queues.get(key)
+            if learner is None or self._filling.get(key) is not marker:
+                return
+            queued = learner.cards
+            pairs = {card.pair for card in queued}
+            pairs.add(learner.shown_pair)
+            for card in cards:
+                if card.pair not in pairs and len(queued) < self.size:
+                    pairs.add(card.pair)
+                    queued.append(card)
+
+
+class NoCardQueue:
+    """
+    Stands in for CardQueue where no cards are prefetched, as in the
+    asyncio bot, whose sessions can't be used from the refill thread:
+    every card is loaded when it is asked for.
+    """
+    def pop(self, user_name, dictionary_type, translate_direction,
+            load = None):
+        return load() if load is not None else None
+
+    def discard_pair(self, user_name, russian_word_id, english_word_id):
+        pass
+
+    def invalidate(self, user_name = None):
+        pass
@@ -1,27 +1,123 @@
 import configparser
+import hashlib
+import itertools
 import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import sqlalchemy
 from sqlalchemy import func
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import (sessionmaker, relationship, declarative_base,
+                            scoped_session)
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from models import (
                     User, RussianWord, EnglishWord, LearnedWord,
-                    RussianEnglishAssociation
+                    RussianEnglishAssociation, StudySchedule, BaseWord,
+                    HiddenBaseWord
 )
 import random
+import cache_manager
+import spaced_repetition
+from lesson_state import StudyCard
 
+logger = logging.getLogger(__name__)
 
+SEED_CHUNK_SIZE = 1000
+SLOW_CHECKOUT = 1.0
+EXPORT_BATCH = 1000
+BASE_DICTIONARY_PATH = 'files/base_dict.json'
+_seed_files = {}
+_synced_base = {}
 
-def create_engine():
+# The result of delete_word: the number of the user's word pairs removed
+# and the texts of the words that were left without any pair and deleted.
+DeletedWords = namedtuple('DeletedWords',
+                          ['associations', 'russian_words', 'english_words'])
+
+
+class PoolWaitStats:
+    """
+    Collects the time handlers spend waiting for a pooled connection.
+
+    Attributes:
+        checkouts (int): The number of connection checkouts.
+        total_wait (float): The sum of all waits, in seconds.
+        max_wait (float): The longest wait, in seconds.
+    """
+    def __init__(self):
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        if wait > SLOW_CHECKOUT:
+            logger.warning('Ожидание соединения из пула заняло %.3f с', wait)
+
+    def stats(self):
+        return {'checkouts': self.checkouts,
+                'avg_wait': (self.total_wait / self.checkouts
+                             if self.checkouts else 0.0),
+                'max_wait': self.max_wait}
+
+
+pool_wait = PoolWaitStats()
+
+
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.record(time.perf_counter() - started)
+
+
+Session = scoped_session(sessionmaker())
+
+
+def read_settings(path = 'settings.ini'):
     config = configparser.ConfigParser()
-    config.read('settings.ini')
+    config.read(path)
+    return config
+
+def get_dsn(config, driver = 'postgresql'):
     db_name = config['Tokens']['db_name']
     user = config['Tokens']['user']
     password = config['Tokens']['password']
     host = config['Tokens']['host']
     port = config['Tokens']['port']
-    DSN = f'postgresql://{user}:{password}@{host}:{port}/{db_name}'
-    engine = sqlalchemy.create_engine(DSN)
+    return f'{driver}://{user}:{password}@{host}:{port}/{db_name}'
+
+def create_engine(config = None):
+    config = config or read_settings()
+    DSN = get_dsn(config)
+    statement_timeout = config.getint('Database', 'statement_timeout',
+                                      fallback = 5000)
+    engine = sqlalchemy.create_engine(
+        DSN,
+        poolclass = TimedQueuePool,
+        pool_size = config.getint('Database', 'pool_size', fallback = 10),
+        max_overflow = config.getint('Database', 'max_overflow',
+                                     fallback = 5),
+        pool_timeout = config.getint('Database', 'pool_timeout',
+                                     fallback = 10),
+        pool_recycle = config.getint('Database', 'pool_recycle',
+                                     fallback = 1800),
+        pool_pre_ping = config.getboolean('Database', 'pool_pre_ping',
+                                          fallback = True),
+        connect_args = {'options': f'-c statement_timeout={statement_timeout}'}
+    )
     return engine
 
 def create_session(engine):
@@ -29,211 +125,505 @@ def create_session(engine):
     session = Session()
     return session
 
-def download_data_from_json(session, path, user_name):
+def configure_session(engine):
+    Session.remove()
+    Session.configure(bind = engine)
+
+@contextmanager
+def session_scope():
+    if Session.registry.has():
+        yield Session()
+        return
+    session = Session()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
+def _insert(session, model):
+    if session.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert(model)
+    return postgresql.insert(model)
+
+def _chunks(items, size = SEED_CHUNK_SIZE):
+    items = iter(items)
+    while chunk := list(itertools.islice(items, size)):
+        yield chunk
+
+def read_seed_file(path):
+    mtime = os.path.getmtime(path)
+    cached = _seed_files.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
     with open(path, encoding='utf-8') as f:
         data = json.load(f)
+    usernames = []
+    pairs = []
     for item in data:
-        model = item['model']
         fields = item['fields']
-        if model == 'User':
-            create_user(username = fields['username'], session = session)
-        elif model == 'Word':
-            user_id = create_user(username = user_name,
-                                  session = session)
-            if user_id:
-                print(f'Пользователь c ID -{user_name}- успешно '
-                      f'добавлен '
-                      f'в базу данных!')
-            else:
-                print(f'При добавлении пользователя  c ID-{user_name}- '
-                      f'в базу данных произошла ошибка!')
-            russian_word_id = create_russian_word(ru_word = fields['ru_word'],
-                                                  session = session)
-            if russian_word_id:
-                print(f'Русское слово -{fields['ru_word']}- успешно '
-                      f'добавлено в словарь пользователя c ID'
-                      f'-{user_id}-!')
-            else:
-                print(f'При добавлении русского слова -{fields['ru_word']}- '
-                      f'в базу данных произошла ошибка!')
-            english_word_id = create_english_word(en_word = fields['en_word'],
-                                                  session = session)
-            if english_word_id:
-                print(f'Английское слово -{fields['en_word']}- успешно '
-                      f'добавлено в словарь пользователя c ID  '
-                      f'-{user_name}-!')
-            else:
-                print(f'При добавлении английского слова '
-                      f'-{fields['en_word']}- в базу данных произошла ошибка!')
-            new_association = create_words_association(russian_word_id,
-                                                       english_word_id,
-                                                       user_id,
-                                                       session)
-            # if new_association:
-            #     print('Связь между русским и английским словами '
-            #               'успешно добавлена в базу данных!')
-            if new_association == None:
-                print('При добавлении связи между русским и английскими '
-                      'словами в базу данных произошла ошибка!')
-            elif new_association == False:
-                print(f'Пара слов {fields['ru_word']} - {fields['en_word']} '
-                      f'уже есть в словаре пользователя c ID '
-                      f'-{user_id}-!')
+        if item['model'] == 'User':
+            usernames.append(fields['username'])
+        elif item['model'] == 'Word':
+            pairs.append((fields['ru_word'], fields['en_word']))
+    seed = (tuple(dict.fromkeys(usernames)), tuple(dict.fromkeys(pairs)))
+    # The version is a hash of the parsed content, so reformatting the
+    # file does not make users set up again.
+    version = hashlib.sha256(
+        json.dumps(seed, ensure_ascii = False).encode('utf-8')).hexdigest()
+    _seed_files[path] = (mtime, seed, version)
+    return seed
 
-def create_user(username, session):
-    all_users = session.query(User.username).all()
-    if all(username != user.username for user in all_users):
-        new_user = User(username = username)
-        session.add(new_user)
+def seed_version(path):
+    read_seed_file(path)
+    return _seed_files[path][2]
+
+def _upsert_values(session, model, column, values):
+    ids = {}
+    for chunk in _chunks(sorted(set(values))):
+        session.execute(
+            _insert(session, model)
+            .on_conflict_do_nothing(index_elements = [column.key]),
+            [{column.key: value} for value in chunk]
+        )
+        ids.update(session.execute(
+            sqlalchemy.select(column, model.id).where(column.in_(chunk))
+        ).all())
+    return ids
+
+def _insert_associations(session, rows):
+    inserted = 0
+    for chunk in _chunks(rows):
+        result = session.execute(
+            _insert(session, RussianEnglishAssociation)
+            .on_conflict_do_nothing(index_elements = [
+                'russian_word_id', 'english_word_id', 'user_id'])
+            .returning(RussianEnglishAssociation.user_id),
+            chunk
+        )
+        inserted += len(result.all())
+    return inserted
+
+def _base_pairs_among(session, pairs):
+    if not pairs:
+        return set()
+    key = sqlalchemy.tuple_(BaseWord.russian_word_id, BaseWord.english_word_id)
+    return set(session.execute(
+        sqlalchemy.select(BaseWord.russian_word_id, BaseWord.english_word_id)
+        .where(key.in_(pairs))
+    ).tuples())
+
+def _store_pairs(session, user_id, pairs):
+    # Base dictionary pairs are already in every dictionary, they are
+    # only shown again if the user had hidden them.
+    ru_ids = _upsert_values(session, RussianWord, RussianWord.ru_word,
+                            [ru_word for ru_word, _ in pairs])
+    en_ids = _upsert_values(session, EnglishWord, EnglishWord.en_word,
+                            [en_word for _, en_word in pairs])
+    id_pairs = [(ru_ids[ru_word], en_ids[en_word])
+                for ru_word, en_word in pairs]
+    base = _base_pairs_among(session, id_pairs)
+    shown = 0
+    if base:
+        key = sqlalchemy.tuple_(HiddenBaseWord.russian_word_id,
+                                HiddenBaseWord.english_word_id)
+        shown = len(session.execute(
+            sqlalchemy.delete(HiddenBaseWord)
+            .where(HiddenBaseWord.user_id == user_id, key.in_(base))
+            .returning(HiddenBaseWord.user_id)
+        ).all())
+    inserted = _insert_associations(session, [
+        {'russian_word_id': russian_word_id,
+         'english_word_id': english_word_id,
+         'user_id': user_id}
+        for russian_word_id, english_word_id in id_pairs
+        if (russian_word_id, english_word_id) not in base
+    ])
+    return ru_ids, en_ids, inserted + shown
+
+def _cache_words(ru_ids, en_ids):
+    cache_manager.russian_word_ids.update(ru_ids)
+    cache_manager.english_word_ids.update(en_ids)
+    for ru_word, word_id in ru_ids.items():
+        cache_manager.russian_words.add(word_id, ru_word)
+    for en_word, word_id in en_ids.items():
+        cache_manager.english_words.add(word_id, en_word)
+
+def sync_base_dictionary(session, path = BASE_DICTIONARY_PATH):
+    # Stores the pairs of the seed file once in base_word. When the file
+    # changes, the new pairs get the next version and the pairs no longer
+    # in it are removed. Every process checks a file version only once.
+    _, pairs = read_seed_file(path)
+    key = (str(session.get_bind().engine.url), path)
+    if _synced_base.get(key) is pairs:
+        return 0, len(pairs)
+    ru_ids = _upsert_values(session, RussianWord, RussianWord.ru_word,
+                            [ru_word for ru_word, _ in pairs])
+    en_ids = _upsert_values(session, EnglishWord, EnglishWord.en_word,
+                            [en_word for _, en_word in pairs])
+    wanted = {(ru_ids[ru_word], en_ids[en_word]) for ru_word, en_word in pairs}
+    stored = set(session.execute(
+        sqlalchemy.select(BaseWord.russian_word_id, BaseWord.english_word_id)
+    ).tuples())
+    added = sorted(wanted - stored)
+    removed = sorted(stored - wanted)
+    if added or removed:
+        version = (session.execute(
+            sqlalchemy.select(func.max(BaseWord.version))
+        ).scalar() or 0) + 1
+        for chunk in _chunks(added):
+            session.execute(
+                _insert(session, BaseWord).on_conflict_do_nothing(),
+                [{'russian_word_id': russian_word_id,
+                  'english_word_id': english_word_id,
+                  'version': version}
+                 for russian_word_id, english_word_id in chunk]
+            )
+        key_columns = sqlalchemy.tuple_(BaseWord.russian_word_id,
+                                        BaseWord.english_word_id)
+        for chunk in _chunks(removed):
+            session.execute(sqlalchemy.delete(BaseWord)
+                            .where(key_columns.in_(chunk)))
+        logger.info('Базовый словарь обновлен до версии %s: добавлено %s, '
+                    'удалено %s пар(ы) слов', version, len(added),
+                    len(removed))
+    session.commit()
+    _cache_words(ru_ids, en_ids)
+    _synced_base[key] = pairs
+    return len(added), len(wanted) - len(added)
+
+def download_data_from_json(session, path, user_name):
+    # A returning user already set up with the current file costs one
+    # lookup by the unique username index. Otherwise the base dictionary
+    # is brought up to date, which only applies the changed pairs, and
+    # the user's marker is moved to the new version.
+    usernames, pairs = read_seed_file(path)
+    version = seed_version(path)
+    user = session.execute(
+        sqlalchemy.select(User.id, User.seed_version)
+        .where(User.username == user_name)
+    ).first()
+    if user is not None and user.seed_version == version:
+        cache_manager.user_ids.put(user_name, user.id)
+        return 0, len(pairs)
+    try:
+        inserted, skipped = sync_base_dictionary(session, path)
+        user_ids = _upsert_values(session, User, User.username,
+                                  usernames + (user_name,))
+        session.execute(sqlalchemy.update(User)
+                        .where(User.id == user_ids[user_name])
+                        .values(seed_version = version))
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        logger.exception('Не удалось загрузить базовый словарь для '
+                         'пользователя c ID -%s-', user_name)
+        raise
+    cache_manager.user_ids.update(user_ids)
+    logger.info('Пользователь c ID -%s- получил базовый словарь версии %s',
+                user_name, version[:12])
+    return inserted, skipped
+
+def import_pairs(session, user_name, pairs, progress = None):
+    # Reads and commits the pairs in batches, so they may come from a
+    # stream of any length. progress(read, added) is called after each.
+    # Returns None when the user could not be created.
+    user_id = create_user(user_name, session)
+    if not user_id:
+        logger.error('Не удалось создать пользователя c ID -%s- для '
+                     'импорта словаря', user_name)
+        return None
+    read = inserted = 0
+    for batch in _chunks(pairs):
+        read += len(batch)
         try:
+            ru_ids, en_ids, added = _store_pairs(session, user_id,
+                                                 list(dict.fromkeys(batch)))
             session.commit()
-            user_id = new_user.id
-        except IntegrityError:
+        except SQLAlchemyError:
             session.rollback()
-            return False
-    else:
-        user_id = session.query(User.id).filter(User.username ==
-                                                username).first()[0]
-    return user_id
+            logger.exception('Не удалось импортировать словарь '
+                             'пользователя c ID -%s-', user_name)
+            raise
+        _cache_words(ru_ids, en_ids)
+        inserted += added
+        if progress is not None:
+            progress(read, inserted)
+    logger.info('Импорт словаря пользователя c ID -%s-: добавлено %s, '
+                'пропущено %s пар(ы) слов', user_name, inserted,
+                read - inserted)
+    return inserted, read - inserted
+
+def _get_or_create(session, model, column, value, cache, pool = None):
+    object_id = cache.get(value)
+    if object_id is not None:
+        return object_id
+    statement = _insert(session, model).values({column.key: value})
+    statement = statement.on_conflict_do_update(
+        index_elements = [column.key],
+        set_ = {column.key: statement.excluded[column.key]}
+    ).returning(model.id)
+    try:
+        object_id = session.execute(statement).scalar_one()
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return False
+    cache.put(value, object_id)
+    if pool is not None:
+        pool.add(object_id, value)
+    return object_id
+
+def create_user(username, session):
+    return _get_or_create(session, User, User.username, username,
+                          cache_manager.user_ids)
 
 def create_russian_word(ru_word, session):
-    rus_dict = session.query(RussianWord).all()
-    if not rus_dict or all(ru_word != r.ru_word for r in rus_dict):
-        rus_word = RussianWord(ru_word = ru_word)
-        session.add(rus_word)
-        try:
-            session.commit()
-            ru_word_id = rus_word.id
-        except IntegrityError:
-            session.rollback()
-            return False
-    else:
-        ru_word_id = session.query(RussianWord.id).filter(RussianWord.ru_word
-                                                       == ru_word).first()[0]
-    return ru_word_id
+    return _get_or_create(session, RussianWord, RussianWord.ru_word, ru_word,
+                          cache_manager.russian_word_ids,
+                          cache_manager.russian_words)
 
 def create_english_word(en_word, session):
-    eng_dict = session.query(EnglishWord).all()
-    if not eng_dict or all(en_word != e.en_word for e in eng_dict):
-        eng_word = EnglishWord(en_word = en_word)
-        session.add(eng_word)
-        try:
-            session.commit()
-            en_word_id = eng_word.id
-        except IntegrityError:
-            session.rollback()
-            return False
-    else:
-        en_word_id = session.query(EnglishWord.id).filter(EnglishWord.en_word
-                                                       == en_word).first()[0]
-    return en_word_id
+    return _get_or_create(session, EnglishWord, EnglishWord.en_word, en_word,
+                          cache_manager.english_word_ids,
+                          cache_manager.english_words)
 
 def create_words_association(russian_word_id, english_word_id, user_id,
                              session):
-    words_associations =  session.query(RussianEnglishAssociation).all()
-    existing_association = session.query(RussianEnglishAssociation).filter_by(
-        russian_word_id = russian_word_id,
-        english_word_id = english_word_id,
-        user_id = user_id
-    ).first()
-    if existing_association and words_associations:
-        return False
-    else:
-        new_association = RussianEnglishAssociation(
-                                            russian_word_id = russian_word_id,
-                                            english_word_id = english_word_id,
-                                            user_id = user_id,
-
-        )
-        session.add(new_association)
+    if session.get(BaseWord, (russian_word_id, english_word_id)):
+        # The pair is in the base dictionary: it is new to the user only
+        # if they had hidden it.
         try:
+            shown = session.execute(sqlalchemy.delete(HiddenBaseWord).where(
+                HiddenBaseWord.user_id == user_id,
+                HiddenBaseWord.russian_word_id == russian_word_id,
+                HiddenBaseWord.english_word_id == english_word_id
+            )).rowcount
             session.commit()
-            return new_association
-        except IntegrityError:
+        except SQLAlchemyError:
             session.rollback()
             return None
+        return shown > 0
+    statement = _insert(session, RussianEnglishAssociation).values(
+        russian_word_id = russian_word_id,
+        english_word_id = english_word_id,
+        user_id = user_id
+    ).on_conflict_do_nothing(index_elements = [
+        'russian_word_id', 'english_word_id', 'user_id'
+    ]).returning(RussianEnglishAssociation.user_id)
+    try:
+        created = session.execute(statement).first() is not None
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return None
+    return created
 
 def mark_word_as_learned(russian_word_id, english_word_id, user_id, session):
-    learned_word = session.query(LearnedWord).all()
-    existing_combination = session.query(LearnedWord).filter_by(
+    statement = _insert(session, LearnedWord).values(
         russian_word_id = russian_word_id,
         english_word_id = english_word_id,
         user_id = user_id
-    ).first()
-    # if existing_combination and learned_word:
-    if existing_combination:
-        return False
-    else:
-        new_learned_word = LearnedWord(
-                                        russian_word_id = russian_word_id,
-                                        english_word_id = english_word_id,
-                                        user_id = user_id)
-        session.add(new_learned_word)
-        try:
-            session.commit()
-            return new_learned_word
-        except IntegrityError as e:
-            session.rollback()
-            # print(e)
-            return None
+    ).on_conflict_do_nothing().returning(LearnedWord.user_id)
+    try:
+        inserted = session.execute(statement).first() is not None
+        session.execute(sqlalchemy.delete(StudySchedule).where(
+            StudySchedule.user_id == user_id,
+            StudySchedule.russian_word_id == russian_word_id,
+            StudySchedule.english_word_id == english_word_id
+        ))
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return None
+    return inserted
+
+def _get_id(session, model, column, value, cache):
+    object_id = cache.get(value)
+    if object_id is None:
+        object_id = session.execute(
+            sqlalchemy.select(model.id).where(column == value)
+        ).scalar()
+        if object_id is not None:
+            cache.put(value, object_id)
+    return object_id
 
 def get_user_id(session, user_name):
-    user_id = session.query(User.id).filter(
-        User.username == user_name
-    ).first()
-    if user_id:
-        return user_id[0]
-    else:
-        return None
+    return _get_id(session, User, User.username, user_name,
+                   cache_manager.user_ids)
 
 def get_english_word_id(session, english_word):
-    english_word_id = session.query(EnglishWord.id).filter(
-        EnglishWord.en_word == english_word
-    ).first()
-    if english_word_id:
-        return english_word_id[0]
-    else:
-        return None
+    return _get_id(session, EnglishWord, func.lower(EnglishWord.en_word),
+                   english_word.lower(), cache_manager.english_word_ids)
 
 def get_russian_word_id(session, russian_word):
-    russian_word_id = session.query(RussianWord.id).filter(
-        RussianWord.ru_word == russian_word
-    ).first()
-    if russian_word_id:
-        return russian_word_id[0]
-    else:
-        return None
+    return _get_id(session, RussianWord, func.lower(RussianWord.ru_word),
+                   russian_word.lower(), cache_manager.russian_word_ids)
 
-def get_learned_words(username, session):
-    user = session.query(User).filter(User.username == username).first()
-    if not user:
-        return []
-    return session.query(LearnedWord).filter(LearnedWord.user_id == user.id).all()
+def export_pairs(session, user_name):
+    # yield_per streams the rows from a server-side cursor where the
+    # driver has one, so only EXPORT_BATCH rows are held at a time.
+    user_id = get_user_id(session, user_name)
+    if not user_id:
+        return
+    pairs = _dictionary_pairs(user_id, 'my_words')
+    statement = sqlalchemy.select(
+        RussianWord.ru_word, EnglishWord.en_word,
+        LearnedWord.user_id.is_not(None).label('learned'),
+        StudySchedule.repetitions, StudySchedule.interval,
+        StudySchedule.due_at
+    ).select_from(pairs).join(
+        RussianWord, RussianWord.id == pairs.c.russian_word_id
+    ).join(
+        EnglishWord, EnglishWord.id == pairs.c.english_word_id
+    ).outerjoin(LearnedWord, sqlalchemy.and_(
+        LearnedWord.user_id == user_id,
+        LearnedWord.russian_word_id == pairs.c.russian_word_id,
+        LearnedWord.english_word_id == pairs.c.english_word_id
+    )).outerjoin(StudySchedule, sqlalchemy.and_(
+        StudySchedule.user_id == user_id,
+        StudySchedule.russian_word_id == pairs.c.russian_word_id,
+        StudySchedule.english_word_id == pairs.c.english_word_id
+    )).order_by(
+        pairs.c.russian_word_id, pairs.c.english_word_id
+    ).execution_options(yield_per = EXPORT_BATCH)
+    yield from session.execute(statement)
 
 def delete_user(username, session):
     user = session.query(User).filter(User.username == username).first()
     if user:
+        user_id = user.id
+        # Learned and hidden pairs no longer go through the associations,
+        # so the ORM cascade from the user does not reach them.
+        for model in (LearnedWord, StudySchedule, HiddenBaseWord):
+            session.execute(sqlalchemy.delete(model)
+                            .where(model.user_id == user_id))
         session.delete(user)
         session.commit()
+        cache_manager.user_ids.pop(username)
         return True
     return False
 
+def forget_russian_word(word_id, ru_word):
+    cache_manager.russian_word_ids.pop(ru_word)
+    cache_manager.russian_words.remove(word_id)
+
+def forget_english_word(word_id, en_word):
+    cache_manager.english_word_ids.pop(en_word)
+    cache_manager.english_words.remove(word_id)
+
 def delete_russian_word(word_id, session):
     word = session.query(RussianWord).filter(RussianWord.id == word_id).first()
     if word:
+        text = word.ru_word
         session.delete(word)
         session.commit()
+        forget_russian_word(word_id, text)
         return True
     return False
 
 def delete_english_word(word_id, session):
     word = session.query(EnglishWord).filter(EnglishWord.id == word_id).first()
     if word:
+        text = word.en_word
         session.delete(word)
         session.commit()
+        forget_english_word(word_id, text)
         return True
     return False
 
+def _delete_orphans(session, model, column, word_ids):
+    # One anti-join removes every word left without any association.
+    if not word_ids:
+        return []
+    association = RussianEnglishAssociation
+    if model is RussianWord:
+        linked = association.russian_word_id == model.id
+        in_base = BaseWord.russian_word_id == model.id
+    else:
+        linked = association.english_word_id == model.id
+        in_base = BaseWord.english_word_id == model.id
+    return session.execute(
+        sqlalchemy.delete(model)
+        .where(model.id.in_(word_ids),
+               ~sqlalchemy.exists().where(linked),
+               ~sqlalchemy.exists().where(in_base))
+        .returning(model.id, column)
+    ).all()
+
+def _hide_base_pairs(session, user_id, russian_word_id, english_word_id):
+    base_pairs = session.execute(
+        sqlalchemy.select(BaseWord.russian_word_id, BaseWord.english_word_id)
+        .where(sqlalchemy.or_(BaseWord.russian_word_id == russian_word_id,
+                              BaseWord.english_word_id == english_word_id))
+    ).all()
+    if not base_pairs:
+        return []
+    return session.execute(
+        _insert(session, HiddenBaseWord)
+        .values([{'user_id': user_id, 'russian_word_id': pair[0],
+                  'english_word_id': pair[1]} for pair in base_pairs])
+        .on_conflict_do_nothing()
+        .returning(HiddenBaseWord.russian_word_id,
+                   HiddenBaseWord.english_word_id)
+    ).all()
+
+def _forget_progress(session, user_id, pairs):
+    for chunk in _chunks([tuple(pair) for pair in pairs]):
+        for model in (StudySchedule, LearnedWord):
+            session.execute(sqlalchemy.delete(model).where(
+                model.user_id == user_id,
+                sqlalchemy.tuple_(model.russian_word_id,
+                                  model.english_word_id).in_(chunk)
+            ))
+
+def delete_word(word, user_name, session):
+    user_id = get_user_id(session, user_name)
+    russian_word_id = get_russian_word_id(session, word)
+    english_word_id = get_english_word_id(session, word)
+    if not user_id or (russian_word_id is None and english_word_id is None):
+        return DeletedWords(0, (), ())
+
+    def owned_by_user(model):
+        return sqlalchemy.and_(
+            model.user_id == user_id,
+            sqlalchemy.or_(model.russian_word_id == russian_word_id,
+                           model.english_word_id == english_word_id)
+        )
+
+    association = RussianEnglishAssociation
+    try:
+        pairs = session.execute(
+            sqlalchemy.delete(association)
+            .where(owned_by_user(association))
+            .returning(association.russian_word_id,
+                       association.english_word_id)
+        ).all()
+        hidden = _hide_base_pairs(session, user_id, russian_word_id,
+                                  english_word_id)
+        # Progress is removed only for the pairs the user just removed,
+        # not for other users' pairs with the word they were learning.
+        _forget_progress(session, user_id, pairs + hidden)
+        russian_words = _delete_orphans(
+            session, RussianWord, RussianWord.ru_word,
+            {russian_word_id for russian_word_id, _ in pairs})
+        english_words = _delete_orphans(
+            session, EnglishWord, EnglishWord.en_word,
+            {english_word_id for _, english_word_id in pairs})
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    for word_id, text in russian_words:
+        forget_russian_word(word_id, text)
+    for word_id, text in english_words:
+        forget_english_word(word_id, text)
+    return DeletedWords(len(pairs) + len(hidden),
+                        tuple(text for _, text in russian_words),
+                        tuple(text for _, text in english_words))
+
 def delete_word_association(russian_word_id, english_word_id, session):
     association = session.query(RussianEnglishAssociation).filter(
         RussianEnglishAssociation.russian_word_id == russian_word_id,
@@ -246,51 +636,261 @@ def delete_word_association(russian_word_id, english_word_id, session):
     return False
 
 def unmark_learned_word(russian_word_id, english_word_id, user_id, session):
-    learned_word = session.query(LearnedWord).filter(
+    deleted = session.execute(sqlalchemy.delete(LearnedWord).where(
         LearnedWord.russian_word_id == russian_word_id,
         LearnedWord.english_word_id == english_word_id,
         LearnedWord.user_id == user_id
+    )).rowcount
+    session.commit()
+    return deleted > 0
+
+def _dictionary_pairs(user_id, dictionary_type):
+    # A user's dictionary is their own associations plus the base pairs
+    # they have not hidden; 'all_words' takes every user's associations.
+    association = RussianEnglishAssociation
+    own = sqlalchemy.select(association.russian_word_id,
+                            association.english_word_id)
+    base = sqlalchemy.select(BaseWord.russian_word_id,
+                             BaseWord.english_word_id)
+    if dictionary_type != 'all_words':
+        own = own.where(association.user_id == user_id)
+        base = base.where(~sqlalchemy.exists().where(
+            HiddenBaseWord.user_id == user_id,
+            HiddenBaseWord.russian_word_id == BaseWord.russian_word_id,
+            HiddenBaseWord.english_word_id == BaseWord.english_word_id
+        ))
+    return sqlalchemy.union_all(own, base).subquery('pairs')
+
+def _is_learned(user_id, russian_word_id, english_word_id):
+    return sqlalchemy.exists().where(
+        LearnedWord.user_id == user_id,
+        LearnedWord.russian_word_id == russian_word_id,
+        LearnedWord.english_word_id == english_word_id
+    )
+
+def _study_pairs(user_id, dictionary_type):
+    pairs = _dictionary_pairs(user_id, dictionary_type)
+    scheduled = sqlalchemy.exists().where(
+        StudySchedule.user_id == user_id,
+        StudySchedule.russian_word_id == pairs.c.russian_word_id,
+        StudySchedule.english_word_id == pairs.c.english_word_id
+    )
+    return sqlalchemy.select(
+        pairs.c.russian_word_id, pairs.c.english_word_id,
+        RussianWord.ru_word, EnglishWord.en_word
+    ).select_from(pairs).join(
+        RussianWord, RussianWord.id == pairs.c.russian_word_id
+    ).join(
+        EnglishWord, EnglishWord.id == pairs.c.english_word_id
+    ).where(~_is_learned(user_id, pairs.c.russian_word_id,
+                         pairs.c.english_word_id), ~scheduled)
+
+def _scheduled_pairs(user_id, dictionary_type):
+    association = RussianEnglishAssociation
+    linked = sqlalchemy.exists().where(
+        association.russian_word_id == StudySchedule.russian_word_id,
+        association.english_word_id == StudySchedule.english_word_id
+    )
+    in_base = sqlalchemy.exists().where(
+        BaseWord.russian_word_id == StudySchedule.russian_word_id,
+        BaseWord.english_word_id == StudySchedule.english_word_id
+    )
+    if dictionary_type != 'all_words':
+        linked = linked.where(association.user_id == user_id)
+        in_base = sqlalchemy.and_(in_base, ~sqlalchemy.exists().where(
+            HiddenBaseWord.user_id == user_id,
+            HiddenBaseWord.russian_word_id == StudySchedule.russian_word_id,
+            HiddenBaseWord.english_word_id == StudySchedule.english_word_id
+        ))
+    return sqlalchemy.select(
+        StudySchedule.russian_word_id, StudySchedule.english_word_id,
+        RussianWord.ru_word, EnglishWord.en_word
+    ).join(
+        RussianWord, RussianWord.id == StudySchedule.russian_word_id
+    ).join(
+        EnglishWord, EnglishWord.id == StudySchedule.english_word_id
+    ).where(
+        StudySchedule.user_id == user_id, sqlalchemy.or_(linked, in_base),
+        ~_is_learned(user_id, StudySchedule.russian_word_id,
+                     StudySchedule.english_word_id)
+    ).order_by(StudySchedule.due_at)
+
+def _probe(session, pairs, condition, descending):
+    # The tie-break between translations of the same word is randomised,
+    # so alternative translations are reachable too.
+    russian_word_id, english_word_id = pairs.selected_columns[:2]
+    translation_order = random.choice([english_word_id,
+                                       english_word_id.desc()])
+    return session.execute(
+        pairs.where(condition).order_by(
+            russian_word_id.desc() if descending else russian_word_id,
+            translation_order
+        ).limit(1)
     ).first()
-    if learned_word:
-        session.delete(learned_word)
+
+def _pair_bounds(user_id, dictionary_type):
+    # The bounds of each source are read separately, so both can use
+    # their indexes; hidden base pairs only widen the range a little.
+    association = RussianEnglishAssociation
+    own = sqlalchemy.select(
+        func.min(association.russian_word_id).label('low'),
+        func.max(association.russian_word_id).label('high'))
+    if dictionary_type != 'all_words':
+        own = own.where(association.user_id == user_id)
+    base = sqlalchemy.select(func.min(BaseWord.russian_word_id),
+                             func.max(BaseWord.russian_word_id))
+    bounds = sqlalchemy.union_all(own, base).subquery('bounds')
+    return sqlalchemy.select(func.min(bounds.c.low), func.max(bounds.c.high))
+
+def choose_new_pairs(session, user_id, dictionary_type, count = 1):
+    # Every pair comes from its own random probe, so the cards of one
+    # refill are not neighbours in the dictionary. The bounds are read
+    # once, and the pairs already chosen are excluded from later probes.
+    low, high = session.execute(_pair_bounds(user_id, dictionary_type)).one()
+    if low is None:
+        return []
+    pairs = _study_pairs(user_id, dictionary_type)
+    russian_word_id, english_word_id = pairs.selected_columns[:2]
+    found = []
+    for _ in range(count):
+        candidates = pairs
+        if found:
+            candidates = pairs.where(
+                sqlalchemy.tuple_(russian_word_id, english_word_id)
+                .not_in([(pair[0], pair[1]) for pair in found]))
+        probe = random.randint(low, high)
+        pair = _probe(session, candidates, russian_word_id >= probe,
+                      descending = False)
+        if pair is None:
+            pair = _probe(session, candidates, russian_word_id < probe,
+                          descending = True)
+        if pair is None:
+            break
+        found.append(pair)
+    return found
+
+def choose_study_pairs(session, user_id, dictionary_type, count = 1):
+    # Due pairs come first, read from the (user_id, due_at) index. Pairs
+    # never answered before fill the rest, and when there are none left,
+    # the pairs due soonest are reviewed ahead of time.
+    scheduled = _scheduled_pairs(user_id, dictionary_type)
+    now = datetime.now(timezone.utc)
+    pairs = session.execute(
+        scheduled.where(StudySchedule.due_at <= now).limit(count)
+    ).all()
+    if len(pairs) < count:
+        # Scheduled pairs are not study pairs, so the two never overlap.
+        pairs += choose_new_pairs(session, user_id, dictionary_type,
+                                  count - len(pairs))
+    if not pairs:
+        pairs = session.execute(scheduled.limit(count)).all()
+    return pairs
+
+def choose_study_pair(session, user_id, dictionary_type):
+    pairs = choose_study_pairs(session, user_id, dictionary_type)
+    return pairs[0] if pairs else None
+
+def record_review(user_id, russian_word_id, english_word_id, quality,
+                  session):
+    schedule = session.get(StudySchedule,
+                           (user_id, russian_word_id, english_word_id))
+    if schedule is None:
+        state = (spaced_repetition.DEFAULT_EASE, 0, 0)
+    else:
+        state = (schedule.ease_factor, schedule.interval,
+                 schedule.repetitions)
+    ease_factor, interval, repetitions, due_at = spaced_repetition.review(
+        *state, quality)
+    values = dict(user_id = user_id, russian_word_id = russian_word_id,
+                  english_word_id = english_word_id,
+                  ease_factor = ease_factor, interval = interval,
+                  repetitions = repetitions, due_at = due_at)
+    statement = _insert(session, StudySchedule).values(**values)
+    statement = statement.on_conflict_do_update(
+        index_elements = ['user_id', 'russian_word_id', 'english_word_id'],
+        set_ = {key: statement.excluded[key] for key in
+                ('ease_factor', 'interval', 'repetitions', 'due_at')}
+    )
+    try:
+        session.execute(statement)
         session.commit()
-        return True
-    return False
+        return due_at
+    except IntegrityError:
+        session.rollback()
+        return None
 
-def get_word_for_study(dictionary_type, translate_direction, user_name,
-                       session):
-    word_set = []
-    user = session.query(User).filter(User.username == user_name).first()
-    if not user:
-        return word_set
-    learned_words = get_learned_words(user_name, session)
-    learned_word_pairs = set((lw.russian_word_id, lw.english_word_id)
-                              for lw in learned_words)
-    if dictionary_type == 'all_words':
-        available_words = session.query(RussianEnglishAssociation).all()
+def _loaded_pool(session, pool, model, column):
+    if not pool.loaded:
+        pool.load(session.execute(
+            sqlalchemy.select(model.id, column)
+            .execution_options(yield_per = SEED_CHUNK_SIZE)
+        ))
+    return pool
+
+def warm_up(session, path = BASE_DICTIONARY_PATH):
+    # Loads what the first lessons would otherwise load on demand: the
+    # base dictionary with its word ids and the distractor pools.
+    sync_base_dictionary(session, path)
+    _loaded_pool(session, cache_manager.russian_words, RussianWord,
+                 RussianWord.ru_word)
+    _loaded_pool(session, cache_manager.english_words, EnglishWord,
+                 EnglishWord.en_word)
+    return len(cache_manager.russian_words), len(cache_manager.english_words)
+
+def pick_distractors(session, translate_direction, russian_word_id,
+                     english_word_id, count = 3):
+    association = RussianEnglishAssociation
+    if translate_direction == 'ru_en_direction':
+        pool = _loaded_pool(session, cache_manager.english_words,
+                            EnglishWord, EnglishWord.en_word)
+        translations = sqlalchemy.union(
+            sqlalchemy.select(association.english_word_id).where(
+                association.russian_word_id == russian_word_id),
+            sqlalchemy.select(BaseWord.english_word_id).where(
+                BaseWord.russian_word_id == russian_word_id))
+        exclude_ids = {english_word_id}
     else:
-        available_words = session.query(RussianEnglishAssociation).filter(
-                            RussianEnglishAssociation.user_id == user.id).all()
-
-    available_words = [w for w in available_words if (
-    w.russian_word_id, w.english_word_id) not in learned_word_pairs]
-    if not available_words:
-        return word_set
-    chosen_pair = random.choice(available_words)
-    russian_word = session.query(RussianWord).get(chosen_pair.russian_word_id)
-    english_word = session.query(EnglishWord).get(chosen_pair.english_word_id)
+        pool = _loaded_pool(session, cache_manager.russian_words,
+                            RussianWord, RussianWord.ru_word)
+        translations = sqlalchemy.union(
+            sqlalchemy.select(association.russian_word_id).where(
+                association.english_word_id == english_word_id),
+            sqlalchemy.select(BaseWord.russian_word_id).where(
+                BaseWord.english_word_id == english_word_id))
+        exclude_ids = {russian_word_id}
+    exclude_ids.update(session.execute(translations).scalars())
+    return pool.sample(count, exclude_ids)
+
+def _make_card(session, translate_direction, pair):
+    russian_word_id, english_word_id, ru_word, en_word = pair
     if translate_direction == 'ru_en_direction':
-        word_set = [russian_word.ru_word, english_word.en_word]
-        other_english_words = session.query(EnglishWord).filter(
-            EnglishWord.id != english_word.id).order_by(
-            func.random()).limit(3).all()
-        word_set.extend([w.en_word for w in other_english_words])
+        prompt, answer = ru_word, en_word
     elif translate_direction == 'en_ru_direction':
-        word_set = [english_word.en_word, russian_word.ru_word]
-        other_russian_words = session.query(RussianWord).filter(
-            RussianWord.id != russian_word.id).order_by(
-            func.random()).limit(3).all()
-        word_set.extend([w.ru_word for w in other_russian_words])
-    random.shuffle(word_set[1:])
-
-    return word_set
\ No newline at end of file
+        prompt, answer = en_word, ru_word
+    else:
+        return None
+    distractors = pick_distractors(session, translate_direction,
+                                   russian_word_id, english_word_id)
+    return StudyCard(prompt, answer, distractors, russian_word_id,
+                     english_word_id, translate_direction)
+
+def get_study_cards(dictionary_type, translate_direction, user_name,
+                    session, count = 1):
+    user_id = get_user_id(session, user_name)
+    if not user_id:
+        return []
+    pairs = choose_study_pairs(session, user_id, dictionary_type, count)
+    cards = (_make_card(session, translate_direction, pair)
+             for pair in pairs)
+    return [card for card in cards if card]
+
+def get_study_card(dictionary_type, translate_direction, user_name,
+                   session):
+    cards = get_study_cards(dictionary_type, translate_direction, user_name,
+                            session)
+    return cards[0] if cards else None
+
+def get_word_for_study(dictionary_type, translate_direction, user_name,
+                       session):
+    return get_study_card(dictionary_type, translate_direction, user_name,
+                          session)
@@ -0,0 +1,550 @@
+"""
+The handler logic shared by bot_manager (TeleBot) and async_bot_manager
+(AsyncTeleBot).
+
+The functions here take a database session, do the work of one update and
+return the replies to send as Reply tuples. The bot modules only register
+the handlers, keep the conversation states and deliver the replies, the
+sync bot through its outbox and the async bot with await, so every fix to
+a handler is made once. Importing this module reads settings.ini but
+builds no bot.
+"""
+import itertools
+import logging
+import random
+import re
+from collections import namedtuple
+
+import cache_manager
+import db_manager as dbm
+import spaced_repetition
+import vocabulary_export
+import vocabulary_import
+from keyboards import (ANSWERS_PER_CARD, get_start_menu, get_select_dict_menu,
+                       get_translation_menu, get_commands_menu,
+                       get_end_lesson_menu, create_confirmation_keyboard,
+                       create_saving_keyboard, remove_keyboard)
+from lesson_state import LessonStateStore, LESSON_TTL, MAX_LESSONS
+from metrics import UpdateMetrics
+from models import LearnedWord, StudySchedule, User
+from query_monitor import QueryMonitor
+from sqlalchemy.exc import SQLAlchemyError
+from telebot import types
+from telebot.handler_backends import State, StatesGroup
+
+logger = logging.getLogger(__name__)
+
+config = dbm.read_settings()
+TOKEN = config['Tokens']['TOKEN']
+LESSON_SETTINGS = config['Lessons'] if config.has_section('Lessons') else {}
+ADMINS = {int(user_id) for user_id in
+          config.get('Bot', 'admins', fallback = '').split(',')
+          if user_id.strip()}
+MAX_MESSAGE_LENGTH = 4096
+MAX_IMPORT_SIZE = config.getint('Import', 'max_file_size',
+                                fallback = 20 * 1024 * 1024)
+IMPORT_PROGRESS_EVERY = config.getint('Import', 'progress_every',
+                                      fallback = 5000)
+IMPORT_TIMEOUT = config.getint('Import', 'timeout', fallback = 60)
+
+query_monitor = QueryMonitor(
+    budget = config.getint('Instrumentation', 'query_budget', fallback = 0),
+    budgets = ({name: int(budget)
+                for name, budget in config['QueryBudget'].items()}
+               if config.has_section('QueryBudget') else None),
+    strict = config.getboolean('Instrumentation', 'strict',
+                               fallback = False),
+    slow_query = config.getint('Instrumentation', 'slow_query_ms',
+                               fallback = 200) / 1000
+)
+update_metrics = UpdateMetrics()
+update_metrics.add_source('pool_wait', dbm.pool_wait.stats)
+update_metrics.add_source('user_id_cache', cache_manager.user_ids.stats)
+update_metrics.add_source('russian_word_id_cache',
+                          cache_manager.russian_word_ids.stats)
+update_metrics.add_source('english_word_id_cache',
+                          cache_manager.english_word_ids.stats)
+
+lessons = LessonStateStore(
+    ttl = int(LESSON_SETTINGS.get('ttl', LESSON_TTL)),
+    max_states = int(LESSON_SETTINGS.get('max_states', MAX_LESSONS))
+)
+
+# One Bot API call in answer to an update: method is 'send_message',
+# 'send_sticker', 'send_document', 'edit_message_text' or
+# 'answer_callback_query', content its text, sticker or file, and options
+# the other keyword arguments. The chat, message and callback query come
+# from the update being answered.
+Reply = namedtuple('Reply', ['method', 'content', 'options'])
+
+
+def message(text, reply_markup = None):
+    return Reply('send_message', text, {'reply_markup': reply_markup})
+
+def sticker(sticker_id):
+    return Reply('send_sticker', sticker_id, {})
+
+def edit(text, reply_markup = None):
+    return Reply('edit_message_text', text, {'reply_markup': reply_markup})
+
+def notify(text = None, show_alert = False):
+    return Reply('answer_callback_query', text, {'show_alert': show_alert})
+
+
+class Labels:
+    START_LABEL = 'Начинаем!🆕\nВыбери направление перевода:'
+    NEXT_ACTION = 'Выберите следующее действие'
+    ALREADY_ANSWERED = ('Вы уже ответили на это слово. Нажмите '
+                        '\'Следующее слово ⏩\', чтобы продолжить.')
+    NOT_ENOUGH_WORDS = ('Недостаточно слов в словаре. Пожалуйста, добавьте '
+                        'больше слов для изучения или сбросьте прогресс '
+                        'изучения используя команду /reset_progress')
+    CORRECT_PHRASES = [
+        'Отлично! Правильный выбор!',
+        'Молодец! Верный перевод!',
+        'Правильно! Так держать!',
+        'Великолепно! Правильный ответ!'
+    ]
+    INCORRECT_PHRASES = [
+        'Упс! Это не верный ответ.',
+        'Мимо! Попробуй еще раз.',
+        'Неправильный выбор! Попробуй снова.',
+        'Не верно, но не сдавайся!'
+    ]
+    HELP = (
+        '🤖 Инструкция по работе с ботом:\n\n'
+        '1️⃣ Начало работы:\n'
+        '   • Используйте команду /start для начала работы\n'
+        '   • Выберите направление перевода (EN ➡️ RU или RU ➡️ EN)\n'
+        '   • Выберите словарь для изучения:\n'
+        '   • \'Все слова 📚\' - общий словарь всех пользователей бота\n'
+        '   • \'Мои слова 📖\' - словарь текущего пользователя\n\n'
+        '2️⃣ Изучение слов:\n'
+        '   • Бот будет показывать слова для перевода\n'
+        '   • Выберите правильный вариант перевода из предложенных\n'
+        '   • Используйте кнопку \'Следующее слово ⏩\' для перехода к '
+        'следующему слову\n\n'
+        '3️⃣ Управление словарем:\n'
+        '   • \'Добавить слово ➕\':  добавление новой пары слов в словарь\n'
+        '   • \'Удалить слово ➖\':  удаление пары слов из словаря\n'
+        '   • Отправьте файл .csv (русское слово, английское слово) или '
+        '.json в формате базового словаря, чтобы добавить много пар '
+        'сразу\n\n'
+        '4️⃣ Завершение урока:\n'
+        '   • Нажмите \'Закончить урок ❌\' для просмотра статистики и '
+        'завершения работы со словарем\n\n'
+        '5️⃣ Дополнительные команды:\n'
+        '   • /export [csv|json] - выгрузка словаря и прогресса в файл\n'
+        '   • /reset_progress - сброс прогресса изучения\n‼️ Внимание! '
+        'Сброс прогресса отменить нельзя!!\n\n'
+        'Удачи в изучении языка! 🌟'
+    )
+class Stickers:
+    CORRECT_STICKERS = [
+        'CAACAgIAAxkBAAOHZ5k4onMUtuHVOYBD3UiLkbCSHn8AAiQBAALjUDAAASluN3-18mMfNgQ',
+        'CAACAgIAAxkBAAOJZ5k4t99ri2kwD_qKHBup-dA80r8AAv8BAALjUDAAAbVxFB9Px_LeNgQ',
+        'CAACAgIAAxkBAAOXZ5k5PEUz2R2lY-R9QmhA48JF5UEAAoAAA-NQMAABK6GZtBHF6Lk2BA',
+        'CAACAgIAAxkBAAOfZ5k5lTkt3d1ZoUHtHVCP_t9DVhAAAqgAA-NQMAABw2dpf7fTyyI2BA',
+        'CAACAgIAAxkBAAOZZ5k5Yu6SqMKH5BVHhJHwO66J6BoAAooAA-NQMAABpkmqNqEkawY2BA',
+        'CAACAgIAAxkBAAOVZ5k5IgYQPubxU0bbaNVPt4wZ7JMAAq4AA-NQMAABDSgLIWw_6EM2BA'
+    ]
+
+    INCORRECT_STICKERS = [
+        'CAACAgIAAxkBAAODZ5k4hYw4hcN_mZoX5W_juUhmLR4AAqAAA-NQMAAB0QmXSwAB_JB9NgQ',
+        'CAACAgIAAxkBAAOFZ5k4nK89SqYIKLJJUVwn7w0J_bEAAv4BAALjUDAAAZ_RW1koLZOGNgQ',
+        'CAACAgIAAxkBAAOLZ5k40dwD52m58T9TpJotw7NBL0wAAoQAA-NQMAAB8kVi1X7e_EU2BA',
+        'CAACAgIAAxkBAAONZ5k41KgHCPM4RFiQOuhvseKtHXMAAiYBAALjUDAAAZOQPN3l-K2NNgQ',
+        'CAACAgIAAxkBAAORZ5k482VmBf6Ek0bwCeF1uCKwJjgAAogAA-NQMAAB_e0dxxhg7Sw2BA',
+        'CAACAgIAAxkBAAOTZ5k49x1XvKVZ-nw594SG6rcWPX0AAowAA-NQMAABKw9NhY2lc7M2BA',
+        'CAACAgIAAxkBAAObZ5k5eQfTo1qvYDAeGxpjY-Z-F0EAAoYAA-NQMAABwC775648wRs2BA',
+        'CAACAgIAAxkBAAOdZ5k5h3WQGXVcARMKMHuA9C0uvMAAAqIAA-NQMAABwkLo4ETW2wo2BA'
+    ]
+
+class AddWordStates(StatesGroup):
+    russian_added_word = State()
+    english_added_word = State()
+
+class DeleteWordStates(StatesGroup):
+    deleted_word = State()
+
+
+def update_label(update):
+    if isinstance(update, types.CallbackQuery):
+        return update.data or ''
+    return ''
+
+def metrics_report():
+    queries = query_monitor.stats()
+    lines = ['Обработчик [callback]: вызовов, ошибок, в работе, '
+             'среднее/p50/p99 мс, запросов на вызов']
+    for (handler, label, count, errors, in_flight, total, p50,
+         p99) in update_metrics.snapshot():
+        mean = total / count * 1000 if count else 0
+        statements = queries.get(handler, {}).get('statements_per_call', 0)
+        lines.append(f'{handler}{f" [{label}]" if label else ""}: {count}, '
+                     f'{errors}, {in_flight}, {mean:.1f}/≤{p50 * 1000:g}/'
+                     f'≤{p99 * 1000:g}, {statements:.1f}')
+    for name, label, values in update_metrics.sources():
+        lines.append(f'{name}: ' + ', '.join(
+            f'{key} {value:.3g}' if isinstance(value, float)
+            else f'{key} {value}' for key, value in values.items()))
+    report = '\n'.join(lines)
+    if len(report) > MAX_MESSAGE_LENGTH:
+        report = report[:MAX_MESSAGE_LENGTH - 1] + '…'
+    return report
+
+def get_answer_options(message):
+    lesson = lessons.peek(message.from_user.id, message.chat.id)
+    return lesson.card.options if lesson is not None else None
+
+def is_russian(text):
+    return bool(re.match('^[а-яА-ЯёЁ]+$', text))
+
+def is_english(text):
+    return bool(re.match('^[a-zA-Z]+$', text))
+
+def is_word_pair(russian_word, english_word):
+    return is_russian(russian_word) and is_english(english_word)
+
+def import_report(added, skipped, rejected):
+    return (f'Импорт завершен.\n'
+            f'Добавлено пар слов: {added}\n'
+            f'Уже были в словаре или повторялись: {skipped}\n'
+            f'Отклонено (не русское или не английское слово): {rejected}')
+
+def deletion_report(word, deleted):
+    if not deleted.associations:
+        return f'Слово - {word} - не найдено в вашем словаре.'
+    text = (f'Слово - {word} - удалено из вашего словаря. '
+            f'Удалено пар слов: {deleted.associations}.')
+    removed = deleted.russian_words + deleted.english_words
+    if removed:
+        text += f'\nБольше не используются и удалены: {', '.join(removed)}.'
+    return text
+
+def export_arguments(message):
+    # /export [csv|json] [user ID], only admins may export other users.
+    file_format = vocabulary_export.FORMATS[0]
+    user_name = message.from_user.id
+    for argument in message.text.split()[1:]:
+        if argument.lower() in vocabulary_export.FORMATS:
+            file_format = argument.lower()
+        elif argument.isdigit() and message.from_user.id in ADMINS:
+            user_name = int(argument)
+    return file_format, user_name
+
+def reset_users_progress(user_id, session):
+    try:
+        user = session.query(User).filter(User.username == user_id).first()
+        if not user:
+            return False, 'Пользователь не найден!'
+        deleted = session.query(LearnedWord).filter(
+            LearnedWord.user_id == user.id).delete()
+        session.query(StudySchedule).filter(
+            StudySchedule.user_id == user.id).delete()
+        session.commit()
+        return True, f'Прогресс сброшен. Удалено {deleted} выученных слов(а)!'
+    except Exception as e:
+        session.rollback()
+        return False, f'Произошла ошибка при сбросе прогресса: {str(e)}'
+
+
+def get_next_card(session, card_queue, user_name, lesson):
+    return card_queue.pop(
+        user_name, lesson.dict_type, lesson.translate_direction,
+        load = lambda: dbm.get_study_card(lesson.dict_type,
+                                          lesson.translate_direction,
+                                          user_name, session))
+
+def record_answer(session, card_queue, user_name, card, attempts, correct):
+    user_id = dbm.get_user_id(session, user_name)
+    if not user_id:
+        return
+    quality = spaced_repetition.answer_quality(correct, attempts)
+    dbm.record_review(user_id, card.russian_word_id, card.english_word_id,
+                      quality, session)
+    card_queue.discard_pair(user_name, *card.pair)
+
+def card_texts(lesson, card):
+    is_en_ru = lesson.translate_direction == 'en_ru_direction'
+    header_text = (f'{'Translate word' if is_en_ru else 'Переведи слово'}:\n'
+                   f'👉{card.prompt}👈')
+    task_text = f'{'Choose a translation option' if is_en_ru else
+                   'Выбери вариант перевода'}:'
+    return header_text, task_text
+
+
+def start(session, user_name):
+    dbm.download_data_from_json(session = session,
+                                path = dbm.BASE_DICTIONARY_PATH,
+                                user_name = user_name)
+
+def start_replies():
+    return [message(Labels.START_LABEL, get_start_menu())]
+
+def help_replies():
+    return [message(Labels.HELP)]
+
+def metrics_replies():
+    return [message(metrics_report())]
+
+def add_word_replies():
+    return [message('Введите русское слово:', remove_keyboard())]
+
+def russian_word_replies():
+    return [message('Теперь введите соответствующий русскому слову '
+                    'английский перевод:')]
+
+def delete_word_replies():
+    return [message('Введите слово для удаления (на русском или '
+                    'английском):', remove_keyboard())]
+
+def reset_progress_replies():
+    return [message('Вы уверены, что хотите сбросить весь прогресс '
+                    'обучения? Это действие нельзя отменить!',
+                    remove_keyboard()),
+            message('Подтвердите выбор!', create_confirmation_keyboard())]
+
+def callback_replies(session, card_queue, call, lesson):
+    user_id = call.from_user.id
+    replies = []
+    if call.data in ['en_ru_direction', 'ru_en_direction']:
+        lesson.translate_direction = call.data
+        direction = 'EN ➡️ RU' if call.data == 'en_ru_direction' else 'RU ➡️ EN'
+        text = f'Вы выбрали {direction} перевод.\nВыберите словарь для изучения:'
+        replies.append(edit(text, get_select_dict_menu()))
+    elif call.data == 'go_back_direction':
+        replies.append(edit(Labels.START_LABEL, get_start_menu()))
+    elif call.data in ['all_words', 'my_words']:
+        lesson.dict_type = call.data
+        card = get_next_card(session, card_queue, user_id, lesson)
+        if card is None or len(card.options) < ANSWERS_PER_CARD:
+            return [notify(Labels.NOT_ENOUGH_WORDS, show_alert = True)]
+        lesson.set_card(card)
+        header_text, task_text = card_texts(lesson, card)
+        replies += [edit(header_text),
+                    message(task_text, get_translation_menu(lesson.card))]
+
+    if call.data == 'confirm':
+        lesson.clear_choice()
+        success, message_text = reset_users_progress(user_id, session)
+        replies += [notify(message_text), edit(message_text)]
+        if success:
+            replies.append(message(Labels.NEXT_ACTION,
+                                   get_translation_menu(lesson.card)))
+    elif call.data == 'cancel':
+        lesson.clear_choice()
+        replies += [notify('Сброс прогресса отменен!'),
+                    edit('Сброс прогресса отменен.'),
+                    message(Labels.NEXT_ACTION,
+                            get_translation_menu(lesson.card))]
+    if call.data == 'save':
+        card = lesson.answered_card
+        lesson.clear_choice()
+        replies += [notify(), edit('Выполняем сохранение!')]
+        learner_id = dbm.get_user_id(session, user_id)
+        new_learned_word = None
+        if card is not None and learner_id:
+            new_learned_word = dbm.mark_word_as_learned(
+                russian_word_id = card.russian_word_id,
+                english_word_id = card.english_word_id,
+                user_id = learner_id,
+                session = session)
+        if new_learned_word:
+            card_queue.discard_pair(user_id, *card.pair)
+            replies.append(message(f'Слово успешно сохранено в изученных!\n'
+                                   f'{Labels.NEXT_ACTION}',
+                                   get_translation_menu(lesson.card)))
+        else:
+            replies.append(message('Ошибка сохранения!',
+                                   get_translation_menu(lesson.card)))
+    elif call.data == 'cancel_save':
+        lesson.clear_choice()
+        replies += [notify(), edit('Сохранение отменено!'),
+                    message(Labels.NEXT_ACTION,
+                            get_translation_menu(lesson.card))]
+
+    if call.data == 'new_lesson':
+        replies.append(edit('Выберите направление перевода для нового '
+                            'урока:', get_start_menu()))
+    elif call.data == 'exit':
+        replies.append(edit('До новых встреч!'))
+
+    replies.append(notify())
+    return replies
+
+def english_word_replies(session, user_name, russian_word, english_word,
+                         lesson):
+    user_id = dbm.create_user(user_name, session)
+    if not user_id:
+        return [message('Произошла ошибка при добавлении пользователя в '
+                        'базу данных!', get_translation_menu(lesson.card))]
+    ru_word_id = dbm.create_russian_word(russian_word, session)
+    en_word_id = dbm.create_english_word(english_word, session)
+    new_association = None
+    if ru_word_id and en_word_id:
+        new_association = dbm.create_words_association(
+            ru_word_id, en_word_id, user_id, session)
+    if new_association:
+        text = (f'Пара слов {russian_word} - {english_word} успешно '
+                f'добавлена в словарь.')
+    elif new_association is False:
+        text = f'Пара слов {russian_word} - {english_word} уже есть в словаре!'
+    else:
+        text = 'Произошла ошибка при добавлении слова в словарь!'
+    return [message(text),
+            message(Labels.NEXT_ACTION, get_translation_menu(lesson.card))]
+
+def document_rejection(document):
+    # Returns the replies refusing the document, or None to import it.
+    if not vocabulary_import.file_format(document.file_name):
+        return [message('Пришлите словарь в файле .csv или .json.')]
+    if (document.file_size or 0) > MAX_IMPORT_SIZE:
+        return [message(f'Файл слишком большой, допускается до '
+                        f'{MAX_IMPORT_SIZE // 1024 // 1024} МБ.')]
+    return None
+
+def document_accepted(document):
+    return [message(f'Загружаю словарь из файла {document.file_name}...')]
+
+def import_progress(report):
+    # Returns the progress callback of db_manager.import_pairs, which
+    # passes a progress text to report every IMPORT_PROGRESS_EVERY pairs.
+    next_report = IMPORT_PROGRESS_EVERY
+
+    def progress(read, added):
+        nonlocal next_report
+        if read >= next_report:
+            report(f'Обработано пар слов: {read}, добавлено: {added}...')
+            next_report = read + IMPORT_PROGRESS_EVERY
+
+    return progress
+
+def read_document(chunks, file_name):
+    return vocabulary_import.read_pairs(chunks, file_name, is_word_pair)
+
+def read_batch(pairs):
+    # The next batch of pairs from read_document, in the batches
+    # db_manager.import_pairs stores; empty once the file is read.
+    return list(itertools.islice(pairs, dbm.SEED_CHUNK_SIZE))
+
+def imported_replies(imported, counts):
+    if imported is None:
+        return [message('Произошла ошибка при добавлении пользователя в '
+                        'базу данных!')]
+    return [message(import_report(*imported, counts['rejected']))]
+
+def import_failed_replies(error):
+    if isinstance(error, ValueError):
+        return [message(f'Не удалось прочитать файл: {error}. Пары из уже '
+                        f'обработанной части файла сохранены.')]
+    return [message('Произошла ошибка при сохранении словаря!')]
+
+def import_replies(session, card_queue, user_name, pairs, counts,
+                   progress = None):
+    try:
+        imported = dbm.import_pairs(session, user_name, pairs, progress)
+    except (ValueError, SQLAlchemyError) as e:
+        return import_failed_replies(e)
+    finally:
+        card_queue.invalidate(user_name)
+    return imported_replies(imported, counts)
+
+def download_failed_replies():
+    return [message('Не удалось скачать файл!')]
+
+def next_action_replies(lesson):
+    return [message(Labels.NEXT_ACTION, get_translation_menu(lesson.card))]
+
+def word_to_delete_replies(session, card_queue, user_name, word, lesson):
+    try:
+        deleted = dbm.delete_word(word, user_name, session)
+        if deleted.russian_words or deleted.english_words:
+            card_queue.invalidate()
+        elif deleted.associations:
+            card_queue.invalidate(user_name)
+        replies = [message(deletion_report(word, deleted))]
+    except Exception:
+        logger.exception('Не удалось удалить слово %s', word)
+        session.rollback()
+        replies = [message('Произошла ошибка при удалении слова!')]
+    return replies + next_action_replies(lesson)
+
+def export_replies(session, user_name, file_format):
+    try:
+        export, count = vocabulary_export.export_file(
+            dbm.export_pairs(session, user_name), file_format)
+    except SQLAlchemyError:
+        logger.exception('Не удалось выгрузить словарь пользователя c ID '
+                         '-%s-', user_name)
+        return [message('Произошла ошибка при выгрузке словаря!')]
+    if not count:
+        export.close()
+        return [message('Словарь пуст, выгружать нечего.')]
+    return [Reply('send_document', export,
+                  {'visible_file_name': f'dictionary_{user_name}.'
+                                        f'{file_format}',
+                   'caption': f'Пар слов в словаре: {count}'})]
+
+def next_word_replies(session, card_queue, user_name, lesson):
+    card = get_next_card(session, card_queue, user_name, lesson)
+    if card is None or len(card.options) < ANSWERS_PER_CARD:
+        return [message(Labels.NOT_ENOUGH_WORDS)]
+    lesson.set_card(card)
+    header_text, task_text = card_texts(lesson, card)
+    return [message(header_text),
+            message(task_text, get_translation_menu(lesson.card))]
+
+def translation_choice_replies(session, card_queue, user_name, lesson,
+                               chosen_word):
+    card = lesson.card
+    if lesson.answered:
+        # The answer buttons stay on the keyboard after the correct answer.
+        # Further taps are ignored, so a card gets one review and is counted
+        # once in the statistics.
+        return [message(Labels.ALREADY_ANSWERED, get_commands_menu())]
+    lesson.current_word_attempts += 1
+    if chosen_word == card.answer:
+        if lesson.current_word_attempts == 1:
+            lesson.correct_answers += 1
+        lesson.answered = True
+        lesson.answered_card = card
+        record_answer(session, card_queue, user_name, card,
+                      lesson.current_word_attempts, correct = True)
+        return [message(random.choice(Labels.CORRECT_PHRASES)),
+                sticker(random.choice(Stickers.CORRECT_STICKERS)),
+                message('Сохранить слово в изученных?',
+                        create_saving_keyboard())]
+    replies = [message(random.choice(Labels.INCORRECT_PHRASES)),
+               sticker(random.choice(Stickers.INCORRECT_STICKERS))]
+    if lesson.translate_direction == 'ru_en_direction':
+        replies.append(message(f'Попробуйте еще раз. Переведите слово '
+                               f'👉{card.prompt}👈'))
+    else:
+        replies.append(message(f'Try again. Translate word: '
+                               f'👉{card.prompt}👈'))
+    if lesson.current_word_attempts >= spaced_repetition.MAX_ATTEMPTS:
+        record_answer(session, card_queue, user_name, card,
+                      lesson.current_word_attempts, correct = False)
+        replies.append(message('Вы использовали все попытки!\nПереходим к '
+                               'следующему слову!'))
+        lesson.current_word_attempts = 0
+        replies += next_word_replies(session, card_queue, user_name, lesson)
+    return replies
+
+def end_lesson_replies(lesson):
+    total_words = lesson.words_studied
+    correct_answers = lesson.correct_answers
+    accuracy = (correct_answers / total_words) * 100 if total_words > 0 else 0
+    result_text = (
+        f'Урок завершен!\n\n'
+        f'📊 Статистика урока:\n'
+        f'📚 Всего слов изучено: {total_words}\n'
+        f'✅ Правильных ответов: {correct_answers}\n'
+        f'🎯 Точность перевода: {accuracy:.2f}%\n\n'
+        f'Хотите начать новый урок?'
+    )
+    lesson.reset_statistics()
+    lesson.clear_choice()
+    return [message(result_text, remove_keyboard()),
+            message(Labels.NEXT_ACTION, get_end_lesson_menu())]
@@ -0,0 +1,111 @@
+import functools
+import json
+import random
+from telebot import types
+from telebot.types import (InlineKeyboardMarkup, InlineKeyboardButton,
+                           ReplyKeyboardRemove)
+
+ANSWER_PLACEHOLDER = '__answer_{}__'
+ANSWERS_PER_CARD = 4
+
+
+class Command:
+    ADD_WORD = 'Добавить слово ➕'
+    DELETE_WORD = 'Удалить слово ➖'
+    NEXT_WORD = 'Следующее слово ⏩'
+    BACK = 'Назад ↩️'
+    END = 'Закончить урок ❌'
+
+
+# The keyboards never change, so each one is built and serialized to JSON
+# once; telebot sends a str reply_markup as is.
+
+@functools.cache
+def get_start_menu():
+    markup = types.InlineKeyboardMarkup(row_width = 2)
+    en_ru_btn = types.InlineKeyboardButton('EN ➡️ RU', callback_data =
+    'en_ru_direction')
+    ru_en_btn = types.InlineKeyboardButton('RU ➡️ EN', callback_data =
+    'ru_en_direction')
+    return markup.add(en_ru_btn, ru_en_btn).to_json()
+
+@functools.cache
+def get_select_dict_menu():
+    markup = types.InlineKeyboardMarkup(row_width = 3)
+    base_dict = types.InlineKeyboardButton('Все слова 📚',
+                                           callback_data = 'all_words')
+    user_dict = types.InlineKeyboardButton('Мои слова 📖',
+                                           callback_data = 'my_words')
+    backstate_btn = types.InlineKeyboardButton(Command.BACK,
+                                         callback_data = 'go_back_direction')
+    return markup.add(base_dict, user_dict, backstate_btn).to_json()
+
+def _build_translation_menu(answers):
+    markup = types.ReplyKeyboardMarkup(row_width = 2)
+    buttons = [types.KeyboardButton(word) for word in answers]
+    next_word_btn = types.KeyboardButton(Command.NEXT_WORD)
+    delete_word_btn = types.KeyboardButton(Command.DELETE_WORD)
+    add_word_btn = types.KeyboardButton(Command.ADD_WORD)
+    close_btn = types.KeyboardButton(Command.END)
+    buttons.extend([add_word_btn, delete_word_btn, next_word_btn, close_btn])
+    return markup.add(*buttons).to_json()
+
+@functools.cache
+def get_translation_menu_template():
+    placeholders = [ANSWER_PLACEHOLDER.format(number)
+                    for number in range(ANSWERS_PER_CARD)]
+    template = _build_translation_menu(placeholders).replace('%', '%%')
+    for placeholder in placeholders:
+        template = template.replace(json.dumps(placeholder), '%s')
+    return template
+
+@functools.cache
+def get_commands_menu():
+    return _build_translation_menu([])
+
+def get_translation_menu(card):
+    answers = [card.answer, *card.distractors]
+    if len(answers) != ANSWERS_PER_CARD or not card.answer:
+        return get_commands_menu()
+    random.shuffle(answers)
+    return get_translation_menu_template() % tuple(map(json.dumps, answers))
+
+@functools.cache
+def get_end_lesson_menu():
+    markup = types.InlineKeyboardMarkup(row_width = 2)
+    new_lesson_btn = types.InlineKeyboardButton('Новый урок',
+                                                callback_data = 'new_lesson')
+    exit_btn = types.InlineKeyboardButton('Пока! 👋',
+                                               callback_data = 'exit')
+    return markup.add(new_lesson_btn, exit_btn).to_json()
+
+@functools.cache
+def create_confirmation_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(
+        InlineKeyboardButton('Да', callback_data = 'confirm'),
+              InlineKeyboardButton('Нет', callback_data = 'cancel')
+    )
+    return keyboard.to_json()
+
+@functools.cache
+def create_saving_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(
+        InlineKeyboardButton('Сохранить', callback_data = 'save'),
+              InlineKeyboardButton('Отменить', callback_data = 'cancel_save')
+    )
+    return keyboard.to_json()
+
+@functools.cache
+def remove_keyboard():
+    return ReplyKeyboardRemove().to_json()
+
+def warm_up():
+    for build in (get_start_menu, get_select_dict_menu,
+                  get_translation_menu_template, get_commands_menu,
+                  get_end_lesson_menu, create_confirmation_keyboard,
+                  create_saving_keyboard, remove_keyboard):
+        build()
+
+warm_up()
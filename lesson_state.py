@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict
+
+LESSON_TTL = 6 * 60 * 60
+MAX_LESSONS = 100000
+
+
+class StudyCard:
+    """
+    Represents one quiz card: a word pair with its answer options.
+
+    The pair ids travel with the card, so checking and saving an answer
+    needs no database lookups.
+
+    Attributes:
+        prompt (str): The word the learner is asked to translate.
+        answer (str): The correct translation of prompt.
+        distractors (tuple): The wrong answer options.
+        russian_word_id (int): The russian word id of the pair.
+        english_word_id (int): The english word id of the pair.
+        translate_direction (str): 'en_ru_direction' or 'ru_en_direction'.
+        options (frozenset): All answer options.
+    """
+    __slots__ = ('prompt', 'answer', 'distractors', 'russian_word_id',
+                 'english_word_id', 'translate_direction', 'options')
+
+    def __init__(self, prompt, answer, distractors, russian_word_id,
+                 english_word_id, translate_direction):
+        self.prompt = prompt
+        self.answer = answer
+        self.distractors = tuple(distractors)
+        self.russian_word_id = russian_word_id
+        self.english_word_id = english_word_id
+        self.translate_direction = translate_direction
+        self.options = frozenset((answer, *self.distractors))
+
+    @property
+    def pair(self):
+        return self.russian_word_id, self.english_word_id
+
+    def __repr__(self):
+        return (f'StudyCard({self.prompt!r}, {self.answer!r}, '
+                f'{self.distractors!r}, {self.russian_word_id}, '
+                f'{self.english_word_id}, {self.translate_direction!r})')
+
+
+NO_CARD = StudyCard('', '', (), None, None, '')
+
+
+class LessonState:
+    """
+    Represents the lesson of one learner in one chat.
+
+    Attributes:
+        card (StudyCard): The card being answered, NO_CARD between cards.
+        answered_card (StudyCard): The last card answered correctly, kept
+                                   until the learner decides to save it.
+        translate_direction (str): 'en_ru_direction' or 'ru_en_direction'.
+        dict_type (str): 'all_words' or 'my_words'.
+        current_word_attempts (int): Answers given for the current card.
+        answered (bool): Whether the current card has been answered
+                         correctly, so that it is counted only once.
+        words_studied (int): Cards shown since the lesson started.
+        correct_answers (int): Cards answered correctly at the first attempt.
+        touched_at (float): The monotonic time of the last access.
+    """
+    __slots__ = ('card', 'answered_card', 'translate_direction', 'dict_type',
+                 'current_word_attempts', 'answered', 'words_studied',
+                 'correct_answers', 'touched_at')
+
+    def __init__(self):
+        self.translate_direction = ''
+        self.dict_type = ''
+        self.touched_at = time.monotonic()
+        self.clear_choice()
+        self.reset_statistics()
+
+    def set_card(self, card):
+        self.card = card
+        self.current_word_attempts = 0
+        self.answered = False
+        self.words_studied += 1
+
+    def clear_choice(self):
+        self.card = NO_CARD
+        self.answered_card = None
+        self.current_word_attempts = 0
+        self.answered = False
+
+    def reset_statistics(self):
+        self.words_studied = 0
+        self.correct_answers = 0
+
+
+class LessonStateStore:
+    """
+    Keeps a LessonState per (user, chat) pair.
+
+    States not used for longer than ttl seconds are evicted, and the least
+    recently used states are dropped once more than max_states are kept,
+    which caps the memory used by idle learners.
+
+    Attributes:
+        ttl (float): Seconds of inactivity after which a state is evicted.
+        max_states (int): The maximum number of states kept in memory.
+    """
+    def __init__(self, ttl = LESSON_TTL, max_states = MAX_LESSONS):
+        self.ttl = ttl
+        self.max_states = max_states
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, user_id, chat_id):
+        key = (user_id, chat_id)
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = LessonState()
+            else:
+                self._states.move_to_end(key)
+            state.touched_at = now
+            self._evict(now)
+            return state
+
+    def peek(self, user_id, chat_id):
+        state = self._states.get((user_id, chat_id))
+        if state is None or time.monotonic() - state.touched_at > self.ttl:
+            return None
+        return state
+
+    def pop(self, user_id, chat_id):
+        with self._lock:
+            return self._states.pop((user_id, chat_id), None)
+
+    def _evict(self, now):
+        states = self._states
+        while states:
+            key, oldest = next(iter(states.items()))
+            if (len(states) <= self.max_states and
+                    now - oldest.touched_at <= self.ttl):
+                break
+            del states[key]
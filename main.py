@@ -1,12 +1,18 @@
-import db_manager as dbm
-from bot_manager import bot
-from models import (create_tables, User, RussianWord, EnglishWord,
-                    RussianEnglishAssociation, LearnedWord)
+from app import create_app
+from webhook_server import create_webhook_server
 
 if __name__ == "__main__":
-    engine = dbm.create_engine()
-    create_tables(engine)
-    session = dbm.create_session(engine)
-    bot.polling(none_stop=True)
-    session.commit()
-    session.close()
\ No newline at end of file
+    app = create_app()
+    bot, config = app.bot, app.config
+    if app.metrics_server:
+        app.metrics_server.start()
+    if config.get('Bot', 'mode', fallback = 'polling') == 'webhook':
+        server = create_webhook_server(bot, config)
+        webhook_url = config.get('Webhook', 'url', fallback = '')
+        if webhook_url:
+            bot.remove_webhook()
+            bot.set_webhook(url = webhook_url,
+                            secret_token = server.secret_token)
+        server.serve_forever()
+    else:
+        bot.polling(none_stop=True)
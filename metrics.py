@@ -0,0 +1,270 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_LABELS = 50
+OTHER_LABEL = 'other'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Series:
+    """
+    The latency histogram and counters of one handler and label.
+
+    Attributes:
+        buckets (list): Observations per bucket of UpdateMetrics.buckets,
+                        the last one for those above every bound.
+        count (int): Finished invocations.
+        total (float): Their summed duration in seconds.
+        errors (int): Invocations that raised.
+        in_flight (int): Invocations running now.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'errors', 'in_flight')
+
+    def __init__(self, size):
+        self.buckets = [0] * (size + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.in_flight = 0
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class UpdateMetrics:
+    """
+    Latency histograms, error counts and in-flight gauges of the update
+    handlers, labelled by handler name and callback data.
+
+    A handler called from another tracked handler is counted as part of
+    it. Every handler keeps at most max_labels distinct labels, the rest
+    are counted under OTHER_LABEL, so that arbitrary callback data can't
+    grow the series without bound.
+
+    Other components, such as the caches and the connection pool, are
+    added with add_source and rendered as gauges next to the handlers.
+
+    Attributes:
+        buckets (tuple): The upper bounds of the histogram buckets
+                         in seconds.
+        max_labels (int): The maximum number of labels per handler.
+        started_at (float): The perf_counter() time the application
+                            started building, see mark_started.
+        time_to_first_update (float): Seconds from started_at to the
+                                      first update, None until then.
+    """
+    def __init__(self, buckets = BUCKETS, max_labels = MAX_LABELS):
+        self.buckets = tuple(buckets)
+        self.max_labels = max_labels
+        self.started_at = None
+        self.time_to_first_update = None
+        self._sources = {}
+        self._series = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._tracking = contextvars.ContextVar('update_metrics',
+                                                default = False)
+
+    def _get_series(self, handler, label):
+        series = self._series.get((handler, label))
+        if series is None:
+            labels = self._labels.setdefault(handler, set())
+            if len(labels) >= self.max_labels:
+                label = OTHER_LABEL
+                series = self._series.get((handler, label))
+        if series is None:
+            labels.add(label)
+            series = self._series[(handler, label)] = Series(
+                len(self.buckets))
+        return series
+
+    def add_source(self, name, stats, label = None):
+        """
+        Adds the numbers of a component to the report.
+
+        Args:
+            name (str): The metric name without the 'bot_' prefix.
+            stats (callable): Returns a dict of numbers by key.
+            label (str): Render one metric labelled with the keys, e.g.
+                         handler names, instead of one metric per key.
+        """
+        self._sources[name] = (stats, label)
+
+    def sources(self):
+        return [(name, label, stats())
+                for name, (stats, label) in sorted(self._sources.items())]
+
+    def mark_started(self, started_at = None):
+        self.started_at = (time.perf_counter() if started_at is None
+                           else started_at)
+        self.time_to_first_update = None
+
+    def _first_update(self, handler):
+        self.time_to_first_update = time.perf_counter() - self.started_at
+        logger.info('Первое обновление (%s) через %.3f с после запуска',
+                    handler, self.time_to_first_update)
+
+    @contextmanager
+    def track(self, handler, label = ''):
+        if self._tracking.get():
+            yield
+            return
+        token = self._tracking.set(True)
+        with self._lock:
+            series = self._get_series(handler, label)
+            series.in_flight += 1
+            if (self.time_to_first_update is None
+                    and self.started_at is not None):
+                self._first_update(handler)
+        failed = False
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self._tracking.reset(token)
+            with self._lock:
+                series.in_flight -= 1
+                series.count += 1
+                series.total += elapsed
+                series.errors += failed
+                series.buckets[bisect.bisect_left(self.buckets,
+                                                  elapsed)] += 1
+
+    def quantile(self, series, share):
+        # The upper bound of the bucket holding the quantile, which is
+        # all a histogram can tell.
+        rank = series.count * share
+        seen = 0
+        for bound, observed in zip(self.buckets, series.buckets):
+            seen += observed
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            return [(handler, label, series.count, series.errors,
+                     series.in_flight, series.total,
+                     self.quantile(series, 0.5), self.quantile(series, 0.99))
+                    for (handler, label), series
+                    in sorted(self._series.items())]
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        durations = ['# HELP bot_update_duration_seconds Время обработки '
+                     'обновления.',
+                     '# TYPE bot_update_duration_seconds histogram']
+        errors = ['# HELP bot_update_errors_total Обновления, обработка '
+                  'которых завершилась ошибкой.',
+                  '# TYPE bot_update_errors_total counter']
+        in_flight = ['# HELP bot_updates_in_flight Обновления в обработке.',
+                     '# TYPE bot_updates_in_flight gauge']
+        with self._lock:
+            for (handler, label), series in sorted(self._series.items()):
+                labels = (f'handler="{_escape(handler)}",'
+                          f'callback_data="{_escape(label)}"')
+                cumulative = 0
+                for bound, observed in zip(self.buckets + (None,),
+                                           series.buckets):
+                    cumulative += observed
+                    le = '+Inf' if bound is None else repr(bound)
+                    durations.append(f'bot_update_duration_seconds_bucket'
+                                     f'{{{labels},le="{le}"}} {cumulative}')
+                durations.append(f'bot_update_duration_seconds_sum'
+                                 f'{{{labels}}} {series.total}')
+                durations.append(f'bot_update_duration_seconds_count'
+                                 f'{{{labels}}} {series.count}')
+                errors.append(f'bot_update_errors_total{{{labels}}} '
+                              f'{series.errors}')
+                in_flight.append(f'bot_updates_in_flight{{{labels}}} '
+                                 f'{series.in_flight}')
+            first_update = self.time_to_first_update
+        lines = durations + errors + in_flight
+        if first_update is not None:
+            lines += ['# HELP bot_time_to_first_update_seconds Время от '
+                      'запуска до первого обновления.',
+                      '# TYPE bot_time_to_first_update_seconds gauge',
+                      f'bot_time_to_first_update_seconds {first_update}']
+        for name, label, values in self.sources():
+            if label:
+                lines.append(f'# TYPE bot_{name} gauge')
+                lines += [f'bot_{name}{{{label}="{_escape(key)}"}} {value}'
+                          for key, value in sorted(values.items())]
+                continue
+            for key, value in values.items():
+                lines += [f'# TYPE bot_{name}_{key} gauge',
+                          f'bot_{name}_{key} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Serves UpdateMetrics.render() on GET requests to path, for Prometheus
+    to scrape.
+
+    Attributes:
+        metrics (UpdateMetrics): The metrics to serve.
+        path (str): The URL path of the metrics.
+    """
+    def __init__(self, metrics, host = '127.0.0.1', port = 9100,
+                 path = '/metrics'):
+        self.metrics = metrics
+        self.path = path
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    def _make_handler(self):
+        server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+                body = server.metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return MetricsHandler
+
+    def start(self):
+        threading.Thread(target = self.httpd.serve_forever,
+                         name = 'metrics-http', daemon = True).start()
+        logger.info('Метрики доступны на %s:%s%s',
+                    *self.httpd.server_address[:2], self.path)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def create_metrics_server(metrics, config):
+    port = config.getint('Metrics', 'port', fallback = 0)
+    if not port:
+        return None
+    return MetricsServer(
+        metrics,
+        host = config.get('Metrics', 'host', fallback = '127.0.0.1'),
+        port = port,
+        path = config.get('Metrics', 'path', fallback = '/metrics')
+    )
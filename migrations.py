@@ -0,0 +1,426 @@
+"""
+Versioned schema migrations, applied at startup by app.py.
+
+Usage (from the project root):
+    python migrations.py [--dry-run]
+
+The applied versions are kept in the schema_version table. With --dry-run
+the pending migrations are applied inside a transaction that is rolled
+back, and the EXPLAIN plans of the main db_manager queries are printed
+before and after them.
+"""
+import argparse
+import json
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import sqlalchemy as sq
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+import db_manager as dbm
+from models import User, RussianWord, EnglishWord, LearnedWord, StudySchedule
+
+logger = logging.getLogger(__name__)
+
+# Any constant works, it only has to be the same for every bot process.
+MIGRATION_LOCK_ID = 7413
+BASE_DICTIONARY_PATH = 'files/base_dict.json'
+CHUNK_SIZE = 500
+
+Migration = namedtuple('Migration', ['version', 'name', 'apply'])
+
+schema_version = sq.Table(
+    'schema_version', sq.MetaData(),
+    sq.Column('version', sq.Integer, primary_key = True),
+    sq.Column('name', sq.String(100), nullable = False),
+    sq.Column('applied_at', sq.DateTime(timezone = True), nullable = False)
+)
+
+# The tables as the migrations create them. A migration must do the same
+# whenever it runs, so it uses these definitions instead of models.py,
+# which describes only the latest schema.
+schema = sq.MetaData()
+
+user = sq.Table(
+    'user', schema,
+    sq.Column('id', sq.Integer, primary_key = True),
+    sq.Column('username', sq.BigInteger, unique = True, nullable = False)
+)
+
+russian_word = sq.Table(
+    'russian_word', schema,
+    sq.Column('id', sq.Integer, primary_key = True),
+    sq.Column('ru_word', sq.String(100), unique = True, nullable = False)
+)
+sq.Index('ix_russian_word_ru_word_lower',
+         sq.func.lower(russian_word.c.ru_word))
+
+english_word = sq.Table(
+    'english_word', schema,
+    sq.Column('id', sq.Integer, primary_key = True),
+    sq.Column('en_word', sq.String(100), unique = True, nullable = False)
+)
+sq.Index('ix_english_word_en_word_lower',
+         sq.func.lower(english_word.c.en_word))
+
+association = sq.Table(
+    'russian_english_association', schema,
+    sq.Column('russian_word_id', sq.Integer,
+              sq.ForeignKey('russian_word.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('english_word_id', sq.Integer,
+              sq.ForeignKey('english_word.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('user_id', sq.Integer,
+              sq.ForeignKey('user.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.UniqueConstraint('russian_word_id', 'english_word_id', 'user_id',
+                        name = 'uq_russian_english_user'),
+    sq.Index('ix_association_user_words', 'user_id', 'russian_word_id',
+             'english_word_id')
+)
+
+learned_words = sq.Table(
+    'learned_words', schema,
+    sq.Column('russian_word_id', sq.Integer, primary_key = True),
+    sq.Column('english_word_id', sq.Integer, primary_key = True),
+    sq.Column('user_id', sq.Integer, primary_key = True),
+    sq.ForeignKeyConstraint(
+        ['russian_word_id', 'english_word_id', 'user_id'],
+        ['russian_english_association.russian_word_id',
+         'russian_english_association.english_word_id',
+         'russian_english_association.user_id'],
+        ondelete = 'CASCADE'
+    ),
+    sq.Index('ix_learned_words_user_words', 'user_id', 'russian_word_id',
+             'english_word_id')
+)
+
+study_schedule = sq.Table(
+    'study_schedule', schema,
+    sq.Column('user_id', sq.Integer,
+              sq.ForeignKey('user.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('russian_word_id', sq.Integer,
+              sq.ForeignKey('russian_word.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('english_word_id', sq.Integer,
+              sq.ForeignKey('english_word.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('ease_factor', sq.Float, nullable = False),
+    sq.Column('interval', sq.Integer, nullable = False),
+    sq.Column('repetitions', sq.Integer, nullable = False),
+    sq.Column('due_at', sq.DateTime(timezone = True), nullable = False),
+    sq.Index('ix_study_schedule_user_due', 'user_id', 'due_at')
+)
+
+base_word = sq.Table(
+    'base_word', schema,
+    sq.Column('russian_word_id', sq.Integer,
+              sq.ForeignKey('russian_word.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('english_word_id', sq.Integer,
+              sq.ForeignKey('english_word.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('version', sq.Integer, nullable = False),
+    sq.Index('ix_base_word_english_word', 'english_word_id')
+)
+
+hidden_base_word = sq.Table(
+    'hidden_base_word', schema,
+    sq.Column('user_id', sq.Integer,
+              sq.ForeignKey('user.id', ondelete = 'CASCADE'),
+              primary_key = True),
+    sq.Column('russian_word_id', sq.Integer, primary_key = True),
+    sq.Column('english_word_id', sq.Integer, primary_key = True),
+    sq.ForeignKeyConstraint(
+        ['russian_word_id', 'english_word_id'],
+        ['base_word.russian_word_id', 'base_word.english_word_id'],
+        ondelete = 'CASCADE'
+    )
+)
+
+
+def _create_tables(*tables, indexes = ()):
+    # Tables are created without their indexes, the later migrations that
+    # add an index name it explicitly.
+    def apply(connection):
+        for table in tables:
+            connection.execute(CreateTable(table, if_not_exists = True))
+        _create_indexes(*indexes)(connection)
+    return apply
+
+def _create_indexes(*names):
+    def apply(connection):
+        for table in schema.sorted_tables:
+            for index in table.indexes:
+                if index.name in names:
+                    connection.execute(CreateIndex(index,
+                                                   if_not_exists = True))
+    return apply
+
+def _insert(connection, table):
+    if connection.dialect.name == 'sqlite':
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+def _chunks(items):
+    return [items[start:start + CHUNK_SIZE]
+            for start in range(0, len(items), CHUNK_SIZE)]
+
+def _relax_learned_words_foreign_key(connection):
+    # Learned pairs may now come from the base dictionary, so learned_words
+    # references the user and the words instead of an association. SQLite
+    # can't drop a constraint in place, and its foreign keys are not
+    # enforced by the bot's connections, so it keeps the old one.
+    if connection.dialect.name != 'postgresql':
+        return
+    for foreign_key in sq.inspect(connection).get_foreign_keys(
+            learned_words.name):
+        if foreign_key['referred_table'] != association.name:
+            continue
+        connection.execute(sq.text(
+            f'ALTER TABLE learned_words '
+            f'DROP CONSTRAINT "{foreign_key["name"]}"'))
+        for column, referred in (('user_id', '"user"'),
+                                 ('russian_word_id', 'russian_word'),
+                                 ('english_word_id', 'english_word')):
+            connection.execute(sq.text(
+                f'ALTER TABLE learned_words ADD CONSTRAINT '
+                f'learned_words_{column}_fkey FOREIGN KEY ({column}) '
+                f'REFERENCES {referred} (id) ON DELETE CASCADE'))
+
+def _read_base_pairs(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f'Миграции нужен базовый словарь {path}, запустите ее из '
+            f'корня проекта')
+    with open(path, encoding = 'utf-8') as f:
+        data = json.load(f)
+    return list(dict.fromkeys(
+        (item['fields']['ru_word'], item['fields']['en_word'])
+        for item in data if item['model'] == 'Word'))
+
+def _word_ids(connection, table, column, words):
+    ids = {}
+    for chunk in _chunks(sorted(set(words))):
+        connection.execute(
+            _insert(connection, table)
+            .on_conflict_do_nothing(index_elements = [column.name]),
+            [{column.name: word} for word in chunk])
+        ids.update(connection.execute(
+            sq.select(column, table.c.id).where(column.in_(chunk))
+        ).all())
+    return ids
+
+def _load_base_dictionary(connection, path = BASE_DICTIONARY_PATH):
+    # The first version of the base dictionary, as db_manager would store
+    # it; later versions are applied by db_manager at startup.
+    pairs = _read_base_pairs(path)
+    ru_ids = _word_ids(connection, russian_word, russian_word.c.ru_word,
+                       [ru_word for ru_word, _ in pairs])
+    en_ids = _word_ids(connection, english_word, english_word.c.en_word,
+                       [en_word for _, en_word in pairs])
+    rows = [{'russian_word_id': ru_ids[ru_word],
+             'english_word_id': en_ids[en_word], 'version': 1}
+            for ru_word, en_word in pairs]
+    for chunk in _chunks(rows):
+        connection.execute(
+            _insert(connection, base_word).on_conflict_do_nothing(), chunk)
+
+def _share_base_dictionary(connection):
+    connection.execute(CreateTable(base_word, if_not_exists = True))
+    connection.execute(CreateTable(hidden_base_word, if_not_exists = True))
+    _create_indexes('ix_base_word_english_word')(connection)
+    _relax_learned_words_foreign_key(connection)
+    _load_base_dictionary(connection)
+    # Base pairs a user had deleted from their copy stay deleted. Users
+    # without any pairs never got a copy and see the whole base.
+    own_pair = sq.exists().where(
+        association.c.user_id == user.c.id,
+        association.c.russian_word_id == base_word.c.russian_word_id,
+        association.c.english_word_id == base_word.c.english_word_id)
+    connection.execute(hidden_base_word.insert().from_select(
+        ['user_id', 'russian_word_id', 'english_word_id'],
+        sq.select(user.c.id, base_word.c.russian_word_id,
+                  base_word.c.english_word_id)
+        .select_from(user).join(base_word, sq.true())
+        .where(~own_pair,
+               sq.exists().where(association.c.user_id == user.c.id))
+    ))
+    connection.execute(association.delete().where(sq.exists().where(
+        base_word.c.russian_word_id == association.c.russian_word_id,
+        base_word.c.english_word_id == association.c.english_word_id)))
+
+def _add_columns(table, *columns):
+    def apply(connection):
+        existing = {column['name'] for column in
+                    sq.inspect(connection).get_columns(table.name)}
+        preparer = connection.dialect.identifier_preparer
+        for column in columns:
+            if column.name in existing:
+                continue
+            connection.execute(sq.text(
+                f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN '
+                f'{preparer.quote(column.name)} '
+                f'{column.type.compile(dialect = connection.dialect)}'))
+    return apply
+
+# The baseline is the schema the migrations started from. Databases
+# created before there were migrations already have its tables and get
+# only the ones they miss.
+MIGRATIONS = [
+    Migration(1, 'baseline',
+              _create_tables(user, russian_word, english_word, association,
+                             learned_words, study_schedule,
+                             indexes = ('ix_study_schedule_user_due',))),
+    Migration(2, 'user_id_indexes',
+              _create_indexes('ix_association_user_words',
+                              'ix_learned_words_user_words')),
+    Migration(3, 'word_text_lower_indexes',
+              _create_indexes('ix_russian_word_ru_word_lower',
+                              'ix_english_word_en_word_lower')),
+    Migration(4, 'shared_base_dictionary', _share_base_dictionary),
+    Migration(5, 'user_seed_version',
+              _add_columns(user, sq.Column('seed_version', sq.String(64)))),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(connection):
+    schema_version.create(connection, checkfirst = True)
+    return connection.execute(
+        sq.select(sq.func.max(schema_version.c.version))
+    ).scalar() or 0
+
+def is_current(connection):
+    # A read-only check, so an up to date database is neither locked nor
+    # written to at startup.
+    if not sq.inspect(connection).has_table(schema_version.name):
+        return False
+    return connection.execute(
+        sq.select(sq.func.max(schema_version.c.version))
+    ).scalar() == LATEST_VERSION
+
+def upgrade(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(sq.select(
+            sq.func.pg_advisory_xact_lock(MIGRATION_LOCK_ID)))
+    version = current_version(connection)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        migration.apply(connection)
+        connection.execute(schema_version.insert().values(
+            version = migration.version, name = migration.name,
+            applied_at = datetime.now(timezone.utc)))
+        logger.info('Применена миграция %s: %s', migration.version,
+                    migration.name)
+        applied.append(migration)
+    return applied
+
+def migrate(engine):
+    with engine.connect() as connection:
+        if is_current(connection):
+            logger.info('Схема базы данных актуальна, версия %s',
+                        LATEST_VERSION)
+            return []
+    with engine.begin() as connection:
+        return upgrade(connection)
+
+
+def main_queries(user_id):
+    study_pairs = dbm._study_pairs(user_id, 'my_words')
+    russian_word_id, english_word_id = study_pairs.selected_columns[:2]
+    new_pairs = study_pairs.where(
+        russian_word_id >= 1
+    ).order_by(
+        russian_word_id, english_word_id
+    ).limit(1)
+    due_pairs = dbm._scheduled_pairs(user_id, 'my_words').where(
+        StudySchedule.due_at <= sq.func.current_timestamp()
+    ).limit(1)
+    learned_pairs = sq.select(
+        LearnedWord.russian_word_id, LearnedWord.english_word_id
+    ).where(LearnedWord.user_id == user_id)
+    return {
+        'Поиск пользователя':
+            sq.select(User.id).where(User.username == user_id),
+        'Поиск русского слова':
+            sq.select(RussianWord.id).where(
+                sq.func.lower(RussianWord.ru_word) == 'мир'),
+        'Поиск английского слова':
+            sq.select(EnglishWord.id).where(
+                sq.func.lower(EnglishWord.en_word) == 'world'),
+        'Границы словаря пользователя':
+            dbm._pair_bounds(user_id, 'my_words'),
+        'Новые пары пользователя': new_pairs,
+        'Пары к повторению': due_pairs,
+        'Изученные пары': learned_pairs,
+    }
+
+def explain(connection, statement):
+    compiled = statement.compile(dialect = connection.dialect,
+                                 compile_kwargs = {'literal_binds': True})
+    if connection.dialect.name == 'sqlite':
+        rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}')
+    else:
+        rows = connection.exec_driver_sql(f'EXPLAIN {compiled}')
+    return [row[-1] for row in rows]
+
+def explain_before(connection, statement):
+    # A query may use tables the pending migrations create. It is planned
+    # in a savepoint, so a failed plan does not abort the transaction.
+    savepoint = connection.begin_nested()
+    try:
+        return explain(connection, statement)
+    except DBAPIError:
+        return None
+    finally:
+        savepoint.rollback()
+
+def dry_run(engine, user_id = 1):
+    with engine.connect() as connection:
+        with connection.begin():
+            queries = main_queries(user_id)
+            before = {name: explain_before(connection, statement)
+                      for name, statement in queries.items()}
+            savepoint = connection.begin_nested()
+            applied = upgrade(connection)
+            after = {name: explain(connection, statement)
+                     for name, statement in queries.items()}
+            savepoint.rollback()
+    print('Миграции к применению:',
+          ', '.join(f'{migration.version} ({migration.name})'
+                    for migration in applied) or 'нет')
+    for name in queries:
+        print(f'\n{name}\n  до:')
+        print('\n'.join(f'    {line}' for line in
+                        before[name] or ['(недоступно до миграции)']))
+        print('  после:')
+        print('\n'.join(f'    {line}' for line in after[name]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'показать планы запросов, не меняя схему')
+    parser.add_argument('--user-id', type = int, default = 1,
+                        help = 'пользователь для запросов в --dry-run')
+    args = parser.parse_args()
+    engine = dbm.create_engine()
+    if args.dry_run:
+        dry_run(engine, args.user_id)
+    else:
+        applied = migrate(engine)
+        print(f'Применено миграций: {len(applied)}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    main()
@@ -14,6 +14,8 @@ class User(Base):
     Attributes:
         id (int): The primary key for the user.
         username (int): A unique identifier for the user, cannot be null.
+        seed_version (str): The content hash of the base dictionary the
+                            user was last set up with.
         associations (relationship): A relationship to RussianEnglishAssociation,
                                      representing the user's word associations.
 
@@ -22,6 +24,7 @@ class User(Base):
     __tablename__ = 'user'
     id = sq.Column(sq.Integer, primary_key = True)
     username = sq.Column(sq.BigInteger, unique = True, nullable = False)
+    seed_version = sq.Column(sq.String(64))
 
     associations = relationship('RussianEnglishAssociation',
                                  back_populates = 'user',
@@ -48,6 +51,10 @@ class RussianWord(Base):
     id = sq.Column(sq.Integer, primary_key = True)
     ru_word = sq.Column(sq.String(100), unique = True, nullable = False)
 
+    __table_args__ = (
+        sq.Index('ix_russian_word_ru_word_lower', sq.func.lower(ru_word)),
+    )
+
     associations = relationship('RussianEnglishAssociation',
                                 back_populates = 'russian_word',
                                 cascade = 'all, delete-orphan')
@@ -86,6 +93,10 @@ class EnglishWord(Base):
     id = sq.Column(sq.Integer, primary_key = True)
     en_word = sq.Column(sq.String(100), unique = True, nullable = False)
 
+    __table_args__ = (
+        sq.Index('ix_english_word_en_word_lower', sq.func.lower(en_word)),
+    )
+
     associations = relationship('RussianEnglishAssociation',
                                 back_populates = 'english_word',
                                 cascade = 'all, delete-orphan')
@@ -111,8 +122,6 @@ class RussianEnglishAssociation(Base):
                              the russian word.
         english_word (relationship): A relationship to EnglishWord, representing
                              the english word.
-        learned_words (relationship): A relationship to LearnedWord, representing
-                             the words learned by the user.
 
         Table name: 'russian_english_association'
     """
@@ -133,14 +142,13 @@ class RussianEnglishAssociation(Base):
                                 back_populates = 'associations')
     english_word = relationship('EnglishWord',
                                 back_populates = 'associations')
-    learned_words = relationship('LearnedWord',
-                                 back_populates = 'association',
-                                 cascade = 'all, delete-orphan')
 
     __table_args__ = (
         sq.UniqueConstraint('russian_word_id', 'english_word_id',
                             'user_id',
                             name = 'uq_russian_english_user'),
+        sq.Index('ix_association_user_words', 'user_id', 'russian_word_id',
+                 'english_word_id'),
     )
 
 class LearnedWord(Base):
@@ -150,34 +158,144 @@ class LearnedWord(Base):
 
     This class defines the structure for the 'learned_words'
     table in the database. It includes columns for the foreign keys
-    for the russian and english words and the user.
+    for the russian and english words and the user. The pair may come
+    from the user's own associations or from the shared base dictionary,
+    so it does not reference russian_english_association.
 
     Attributes:
         russian_word_id (int): The foreign key for the russian word.
         english_word_id (int): The foreign key for the english word.
         user_id (int): The foreign key for the user.
-        association (relationship): A relationship to RussianEnglishAssociation,
-                             representing the association between the words.
 
     Table name: 'learned_words'
     """
     __tablename__ = 'learned_words'
+
+    russian_word_id = sq.Column(sq.Integer,
+                                sq.ForeignKey('russian_word.id',
+                                              ondelete = 'CASCADE'),
+                                primary_key = True)
+    english_word_id = sq.Column(sq.Integer,
+                                sq.ForeignKey('english_word.id',
+                                              ondelete = 'CASCADE'),
+                                primary_key = True)
+    user_id = sq.Column(sq.Integer,
+                        sq.ForeignKey('user.id', ondelete = 'CASCADE'),
+                        primary_key = True)
+
+    __table_args__ = (
+        sq.Index('ix_learned_words_user_words', 'user_id', 'russian_word_id',
+                 'english_word_id'),
+    )
+
+class BaseWord(Base):
+    """
+    Represents a pair of the base dictionary, shared by all users.
+
+    This class defines the structure for the 'base_word' table in the
+    database. The base dictionary is stored once instead of being copied
+    into russian_english_association for every user; each user's
+    dictionary is their own associations plus these pairs.
+
+    Attributes:
+        russian_word_id (int): The foreign key for the russian word.
+        english_word_id (int): The foreign key for the english word.
+        version (int): The version of the base dictionary that added
+                       the pair.
+
+    Table name: 'base_word'
+    """
+    __tablename__ = 'base_word'
+
+    russian_word_id = sq.Column(sq.Integer,
+                                sq.ForeignKey('russian_word.id',
+                                              ondelete = 'CASCADE'),
+                                primary_key = True)
+    english_word_id = sq.Column(sq.Integer,
+                                sq.ForeignKey('english_word.id',
+                                              ondelete = 'CASCADE'),
+                                primary_key = True)
+    version = sq.Column(sq.Integer, nullable = False)
+
+    __table_args__ = (
+        sq.Index('ix_base_word_english_word', 'english_word_id'),
+    )
+
+class HiddenBaseWord(Base):
+    """
+    Represents a pair of the base dictionary that a user has deleted
+    from their dictionary.
+
+    This class defines the structure for the 'hidden_base_word' table in
+    the database. A row keeps one base pair out of one user's dictionary
+    without touching the shared base_word table.
+
+    Attributes:
+        user_id (int): The foreign key for the user.
+        russian_word_id (int): The russian word id of the hidden pair.
+        english_word_id (int): The english word id of the hidden pair.
+                               Together with russian_word_id it references
+                               base_word.
+
+    Table name: 'hidden_base_word'
+    """
+    __tablename__ = 'hidden_base_word'
+
+    user_id = sq.Column(sq.Integer,
+                        sq.ForeignKey('user.id', ondelete = 'CASCADE'),
+                        primary_key = True)
     russian_word_id = sq.Column(sq.Integer, primary_key = True)
     english_word_id = sq.Column(sq.Integer, primary_key = True)
-    user_id = sq.Column(sq.Integer, primary_key=True)
 
-    association = relationship('RussianEnglishAssociation',
-                                back_populates = 'learned_words')
     __table_args__ = (
         sq.ForeignKeyConstraint(
-            ['russian_word_id', 'english_word_id', 'user_id'],
-            ['russian_english_association.russian_word_id',
-             'russian_english_association.english_word_id',
-             'russian_english_association.user_id'],
-             ondelete = 'CASCADE'
+            ['russian_word_id', 'english_word_id'],
+            ['base_word.russian_word_id', 'base_word.english_word_id'],
+            ondelete = 'CASCADE'
         ),
     )
 
+class StudySchedule(Base):
+    """
+    Represents the spaced repetition schedule of a word pair for a user.
+
+    This class defines the structure for the 'study_schedule' table in the
+    database. A row is created after the first answer to a pair and is
+    updated after every following one. The index on (user_id, due_at) lets
+    the next due card be read with a single index range scan.
+
+    Attributes:
+        user_id (int): The foreign key for the user.
+        russian_word_id (int): The foreign key for the russian word.
+        english_word_id (int): The foreign key for the english word.
+        ease_factor (float): The SM-2 ease factor of the pair.
+        interval (int): Days until the next review.
+        repetitions (int): Successful reviews in a row.
+        due_at (datetime): When the pair should be reviewed again.
+
+    Table name: 'study_schedule'
+    """
+    __tablename__ = 'study_schedule'
+    user_id = sq.Column(sq.Integer,
+                        sq.ForeignKey('user.id', ondelete = 'CASCADE'),
+                        primary_key = True)
+    russian_word_id = sq.Column(sq.Integer,
+                                sq.ForeignKey('russian_word.id',
+                                              ondelete = 'CASCADE'),
+                                primary_key = True)
+    english_word_id = sq.Column(sq.Integer,
+                                sq.ForeignKey('english_word.id',
+                                              ondelete = 'CASCADE'),
+                                primary_key = True)
+    ease_factor = sq.Column(sq.Float, nullable = False)
+    interval = sq.Column(sq.Integer, nullable = False)
+    repetitions = sq.Column(sq.Integer, nullable = False)
+    due_at = sq.Column(sq.DateTime(timezone = True), nullable = False)
+
+    __table_args__ = (
+        sq.Index('ix_study_schedule_user_due', 'user_id', 'due_at'),
+    )
+
 def create_tables(engine):
     # Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
\ No newline at end of file
@@ -0,0 +1,253 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+MERGE_SEPARATOR = '\n\n'
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """
+    A token bucket that allows rate sends per second with bursts of up to
+    capacity sends, and can be blocked for a while after a 429 response.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'blocked_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class OutgoingCall:
+    """
+    One queued Bot API call: the TeleBot method name and its arguments,
+    and the file it uploads, which is closed once the call is done.
+    """
+    __slots__ = ('method', 'kwargs', 'attempts', 'file')
+
+    def __init__(self, method, kwargs, file = None):
+        self.method = method
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.file = file
+
+    def merge(self, other):
+        if (self.method != 'send_message' or other.method != 'send_message'
+                or self.kwargs.get('reply_markup') is not None):
+            return False
+        first = {key: value for key, value in self.kwargs.items()
+                 if key not in ('text', 'reply_markup')}
+        second = {key: value for key, value in other.kwargs.items()
+                  if key not in ('text', 'reply_markup')}
+        text = self.kwargs['text'] + MERGE_SEPARATOR + other.kwargs['text']
+        if first != second or len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        self.kwargs = dict(other.kwargs, text = text)
+        return True
+
+
+class ChatQueue:
+    __slots__ = ('calls', 'bucket', 'in_flight', 'ready')
+
+    def __init__(self, bucket):
+        self.calls = deque()
+        self.bucket = bucket
+        self.in_flight = False
+        self.ready = False
+
+
+class Outbox:
+    """
+    Queues outgoing messages and sends them from worker threads within
+    Telegram's flood limits.
+
+    Calls to the same chat are sent one at a time and in order, limited by
+    a per-chat token bucket, and all sends share a global token bucket.
+    Consecutive plain text messages to a chat that are still waiting in
+    the queue are merged into one message. When Telegram answers 429 the
+    call is put back and the chat is paused for retry_after seconds.
+
+    Attributes:
+        bot (TeleBot): The bot used to perform the calls.
+        max_retries (int): How many times a call is retried after a 429.
+    """
+    def __init__(self, bot, chat_rate = 1.0, chat_burst = 3,
+                 global_rate = 30.0, workers = 4, max_retries = 3):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = deque()
+        self._pending = 0
+        self._pruned_at = time.monotonic()
+        self._cond = threading.Condition()
+        self._worker_count = workers
+        self._workers = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._put(chat_id, OutgoingCall(
+            'send_message', dict(kwargs, chat_id = chat_id, text = text)))
+
+    def send_sticker(self, chat_id, sticker, **kwargs):
+        self._put(chat_id, OutgoingCall(
+            'send_sticker', dict(kwargs, chat_id = chat_id, sticker = sticker)))
+
+    def send_document(self, chat_id, document, **kwargs):
+        self._put(chat_id, OutgoingCall(
+            'send_document', dict(kwargs, chat_id = chat_id,
+                                  document = document),
+            file = document if hasattr(document, 'seek') else None))
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self._put(chat_id, OutgoingCall(
+            'edit_message_text', dict(kwargs, text = text, chat_id = chat_id,
+                                      message_id = message_id)))
+
+    def join(self, timeout = None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0,
+                                       timeout = timeout)
+
+    def _start_workers(self):
+        # The workers are started by the first call, so that creating the
+        # outbox, e.g. by importing bot_manager, starts no threads.
+        self._workers = [threading.Thread(target = self._run,
+                                          name = f'outbox-{number}',
+                                          daemon = True)
+                         for number in range(self._worker_count)]
+        for worker in self._workers:
+            worker.start()
+
+    def _put(self, chat_id, call):
+        with self._cond:
+            if not self._workers:
+                self._start_workers()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatQueue(
+                    TokenBucket(self.chat_rate, self.chat_burst))
+            if chat.calls and chat.calls[-1].merge(call):
+                self.merged += 1
+                return
+            chat.calls.append(call)
+            self._pending += 1
+            if not chat.in_flight and not chat.ready:
+                chat.ready = True
+                self._ready.append(chat_id)
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now - self._pruned_at > PRUNE_INTERVAL:
+                    self._prune(now)
+                wait = self._global_bucket.wait_time(now)
+                if wait == 0 and self._ready:
+                    wait = None
+                    for _ in range(len(self._ready)):
+                        chat_id = self._ready.popleft()
+                        chat = self._chats[chat_id]
+                        chat_wait = chat.bucket.wait_time(now)
+                        if chat_wait == 0:
+                            self._global_bucket.consume(now)
+                            chat.bucket.consume(now)
+                            chat.ready = False
+                            chat.in_flight = True
+                            return chat_id, chat.calls.popleft()
+                        self._ready.append(chat_id)
+                        wait = chat_wait if wait is None else min(wait,
+                                                                  chat_wait)
+                elif not self._ready:
+                    wait = None
+                self._cond.wait(timeout = wait)
+
+    def _prune(self, now):
+        self._pruned_at = now
+        for chat_id, chat in list(self._chats.items()):
+            if (not chat.calls and not chat.in_flight
+                    and chat.bucket.is_idle(now)):
+                del self._chats[chat_id]
+
+    def _done(self, chat_id, call, retry_after = None):
+        with self._cond:
+            now = time.monotonic()
+            chat = self._chats[chat_id]
+            chat.in_flight = False
+            if retry_after is not None:
+                chat.calls.appendleft(call)
+                chat.bucket.block(now, retry_after)
+            else:
+                self._pending -= 1
+                if call.file is not None:
+                    call.file.close()
+            if chat.calls:
+                chat.ready = True
+                self._ready.append(chat_id)
+            elif chat.bucket.is_idle(now):
+                del self._chats[chat_id]
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            chat_id, call = self._next()
+            retry_after = None
+            if call.file is not None:
+                # A retried upload has to be read from the start again.
+                call.file.seek(0)
+            try:
+                getattr(self.bot, call.method)(**call.kwargs)
+                self.sent += 1
+            except ApiTelegramException as e:
+                call.attempts += 1
+                if e.error_code == 429 and call.attempts <= self.max_retries:
+                    parameters = (e.result_json or {}).get('parameters') or {}
+                    retry_after = parameters.get('retry_after', 1)
+                    self.retried += 1
+                    logger.warning('Telegram 429 для чата %s, повтор через '
+                                   '%s с', chat_id, retry_after)
+                else:
+                    logger.error('Не удалось выполнить %s для чата %s: %s',
+                                 call.method, chat_id, e)
+            except Exception:
+                logger.exception('Не удалось выполнить %s для чата %s',
+                                 call.method, chat_id)
+            self._done(chat_id, call, retry_after)
@@ -0,0 +1,154 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY = 0.2
+MAX_LOGGED_STATEMENT = 500
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class HandlerQueries:
+    """
+    The database work done by one handler invocation.
+
+    Attributes:
+        name (str): The handler name.
+        statements (int): Statements executed.
+        rows (int): Rows returned or changed, as reported by the driver.
+                    SQLite does not report the rows of a SELECT.
+        seconds (float): Time spent executing the statements.
+        budget (int): The allowed number of statements, 0 for no limit.
+    """
+    __slots__ = ('name', 'statements', 'rows', 'seconds', 'budget')
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.statements = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.budget = budget
+
+    @property
+    def over_budget(self):
+        return bool(self.budget) and self.statements > self.budget
+
+
+def redact(parameters):
+    # Keeps the shape of the parameters but not the values, which may
+    # contain what users typed.
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return type(parameters)(redact(value) for value in parameters)
+    if parameters is None:
+        return None
+    return f'<{type(parameters).__name__}>'
+
+
+class QueryMonitor:
+    """
+    Counts the statements, rows and time of every handler invocation with
+    SQLAlchemy engine events, and logs slow statements.
+
+    Handlers are tracked with track(name); statements executed outside of
+    it, e.g. by the card queue worker, are only checked for slowness. In
+    strict mode a handler that runs more statements than its budget gets a
+    QueryBudgetExceeded at the first statement over it, otherwise a
+    warning is logged when it returns.
+
+    Attributes:
+        budget (int): The default statement budget per invocation,
+                      0 for no limit.
+        budgets (dict): Budgets of single handlers by handler name.
+        strict (bool): Raise instead of logging when over budget.
+        slow_query (float): Statements running longer, in seconds,
+                            are logged with their parameters redacted.
+    """
+    def __init__(self, budget = 0, budgets = None, strict = False,
+                 slow_query = SLOW_QUERY):
+        self.budget = budget
+        self.budgets = budgets or {}
+        self.strict = strict
+        self.slow_query = slow_query
+        self._current = contextvars.ContextVar('handler_queries',
+                                               default = None)
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    @contextmanager
+    def track(self, name):
+        queries = self._current.get()
+        if queries is not None:
+            # A handler called from another handler counts towards it.
+            yield queries
+            return
+        queries = HandlerQueries(name, self.budgets.get(name, self.budget))
+        token = self._current.set(queries)
+        try:
+            yield queries
+        finally:
+            self._current.reset(token)
+            self._record(queries)
+
+    def _before_execute(self, connection, cursor, statement, parameters,
+                        context, executemany):
+        queries = self._current.get()
+        if queries is not None:
+            queries.statements += 1
+            if self.strict and queries.over_budget:
+                raise QueryBudgetExceeded(
+                    f'{queries.name}: больше {queries.budget} запросов')
+        context.query_started = time.perf_counter()
+
+    def _after_execute(self, connection, cursor, statement, parameters,
+                       context, executemany):
+        elapsed = time.perf_counter() - context.query_started
+        queries = self._current.get()
+        if queries is not None:
+            queries.seconds += elapsed
+            queries.rows += max(cursor.rowcount, 0)
+        if elapsed >= self.slow_query:
+            text = re.sub(r'\s+', ' ', statement)[:MAX_LOGGED_STATEMENT]
+            logger.warning('Медленный запрос (%.1f мс) в %s: %s; '
+                           'параметры: %s', elapsed * 1000,
+                           queries.name if queries else 'фоне', text,
+                           redact(parameters))
+
+    def _record(self, queries):
+        with self._lock:
+            totals = self._totals.setdefault(queries.name, [0, 0, 0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += queries.statements
+            totals[2] += queries.rows
+            totals[3] += queries.seconds
+            totals[4] += queries.over_budget
+        logger.debug('%s: %s запросов, %s строк, %.1f мс', queries.name,
+                     queries.statements, queries.rows, queries.seconds * 1000)
+        if queries.over_budget:
+            logger.warning('%s превысил бюджет запросов: %s из %s',
+                           queries.name, queries.statements, queries.budget)
+
+    def stats(self):
+        with self._lock:
+            return {name: {'invocations': invocations,
+                           'statements': statements,
+                           'rows': rows,
+                           'ms': round(seconds * 1000, 3),
+                           'statements_per_call': statements / invocations,
+                           'over_budget': over_budget}
+                    for name, (invocations, statements, rows, seconds,
+                               over_budget) in self._totals.items()}
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+PASSING_QUALITY = 3
+MAX_ATTEMPTS = 3
+
+
+def answer_quality(correct, attempts):
+    """
+    Grades an answer on the SM-2 scale from 0 to 5.
+
+    A correct answer at the first attempt is graded 5, and every further
+    attempt lowers the grade by one down to PASSING_QUALITY. A card that
+    was not answered correctly within MAX_ATTEMPTS is graded 1.
+    """
+    if not correct:
+        return 1
+    return max(5 - (attempts - 1), PASSING_QUALITY)
+
+def review(ease_factor, interval, repetitions, quality, now = None):
+    """
+    Applies one SM-2 review to the schedule of a pair.
+
+    Args:
+        ease_factor (float): The current ease factor.
+        interval (int): The current interval in days.
+        repetitions (int): Successful reviews in a row.
+        quality (int): The grade of the answer from 0 to 5.
+        now (datetime): The review time, the current UTC time by default.
+
+    Returns:
+        tuple: The new (ease_factor, interval, repetitions, due_at).
+    """
+    now = now or datetime.now(timezone.utc)
+    if quality < PASSING_QUALITY:
+        repetitions = 0
+        interval = 1
+    else:
+        if repetitions == 0:
+            interval = 1
+        elif repetitions == 1:
+            interval = 6
+        else:
+            interval = round(interval * ease_factor)
+        repetitions += 1
+    ease_factor = max(MIN_EASE, ease_factor + 0.1 -
+                      (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return ease_factor, interval, repetitions, now + timedelta(days = interval)
@@ -0,0 +1,73 @@
+import threading
+from collections import Counter
+
+UNMATCHED = 'unmatched'
+
+
+class TextDispatcher:
+    """
+    Routes text messages to their handlers with dictionary lookups instead
+    of trying every filter in turn.
+
+    A message is routed by its exact text to a command handler first, then
+    to the answer handler if the text is one of the answer options of its
+    chat, and only then through the ordered fallback filters. The cost of a
+    lookup does not depend on the number of commands.
+
+    Attributes:
+        get_options (callable): A function (message) returning the answer
+                                options of the message's chat, or None.
+        counters (Counter): The number of messages routed to every handler
+                            by its name, and of messages left unmatched.
+    """
+    def __init__(self, get_options = None):
+        self.get_options = get_options
+        self.counters = Counter()
+        self._commands = {}
+        self._answer_handler = None
+        self._filters = []
+        self._lock = threading.Lock()
+
+    def command(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                if text in self._commands:
+                    raise ValueError(f'Команда {text!r} уже назначена '
+                                     f'обработчику '
+                                     f'{self._commands[text].__name__}')
+                self._commands[text] = handler
+            return handler
+        return decorator
+
+    def answer(self, handler):
+        self._answer_handler = handler
+        return handler
+
+    def fallback(self, func):
+        def decorator(handler):
+            self._filters.append((func, handler))
+            return handler
+        return decorator
+
+    def route(self, message):
+        text = message.text
+        handler = self._commands.get(text)
+        if handler is None and self._answer_handler is not None:
+            options = self.get_options(message) if self.get_options else None
+            if options and text in options:
+                handler = self._answer_handler
+        if handler is None:
+            handler = next((handler for func, handler in self._filters
+                            if func(message)), None)
+        with self._lock:
+            self.counters[handler.__name__ if handler else UNMATCHED] += 1
+        return handler
+
+    def dispatch(self, message):
+        handler = self.route(message)
+        if handler is not None:
+            return handler(message)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
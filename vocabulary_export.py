@@ -0,0 +1,67 @@
+import csv
+import io
+import json
+import tempfile
+
+FORMATS = ('csv', 'json')
+COLUMNS = ('ru_word', 'en_word', 'learned', 'repetitions', 'interval',
+           'due_at')
+# Files up to this size stay in memory, larger ones are moved to disk.
+SPOOL_SIZE = 1024 * 1024
+
+
+def _fields(row):
+    return {
+        'ru_word': row.ru_word,
+        'en_word': row.en_word,
+        'learned': bool(row.learned),
+        'repetitions': row.repetitions or 0,
+        'interval': row.interval or 0,
+        'due_at': row.due_at.isoformat() if row.due_at else None,
+    }
+
+def write_csv(rows, binary_file):
+    text_file = io.TextIOWrapper(binary_file, encoding = 'utf-8-sig',
+                                 newline = '')
+    writer = csv.DictWriter(text_file, fieldnames = COLUMNS)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(_fields(row))
+        count += 1
+    text_file.flush()
+    text_file.detach()
+    return count
+
+def write_json(rows, binary_file):
+    # The items are in the base_dict.json format, so the file can be
+    # uploaded back to the bot.
+    text_file = io.TextIOWrapper(binary_file, encoding = 'utf-8')
+    text_file.write('[')
+    count = 0
+    for row in rows:
+        item = {'model': 'Word', 'fields': _fields(row)}
+        text_file.write(',\n' if count else '\n')
+        text_file.write(json.dumps(item, ensure_ascii = False))
+        count += 1
+    text_file.write('\n]\n')
+    text_file.flush()
+    text_file.detach()
+    return count
+
+def export_file(rows, file_format):
+    """
+    Writes the rows as they are read into a temporary file.
+
+    Args:
+        rows (iterable): Rows with the attributes named in COLUMNS.
+        file_format (str): 'csv' or 'json'.
+
+    Returns:
+        tuple: The file, positioned at its start, and the number of rows.
+    """
+    binary_file = tempfile.SpooledTemporaryFile(max_size = SPOOL_SIZE)
+    write = write_json if file_format == 'json' else write_csv
+    count = write(rows, binary_file)
+    binary_file.seek(0)
+    return binary_file, count
@@ -0,0 +1,129 @@
+import codecs
+import csv
+import json
+import os
+
+READ_SIZE = 64 * 1024
+FORMATS = ('.csv', '.json')
+CSV_HEADER = ('ru_word', 'en_word')
+
+
+def file_format(file_name):
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return extension if extension in FORMATS else None
+
+def decode(chunks):
+    # utf-8-sig drops the byte order mark spreadsheet programs put in CSV.
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final = True)
+    if text:
+        yield text
+
+def _lines(texts):
+    rest = ''
+    for text in texts:
+        lines = (rest + text).splitlines(keepends = True)
+        rest = lines.pop() if lines and not lines[-1].endswith(
+            ('\n', '\r')) else ''
+        yield from lines
+    if rest:
+        yield rest
+
+def iter_json_items(texts):
+    """
+    Yields the items of a top-level JSON array one at a time, reading the
+    text as it comes, so only the current item is kept in memory.
+
+    Raises:
+        ValueError: The text is not a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    texts = iter(texts)
+    buffer = ''
+    position = 0
+    started = False
+    while True:
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+        if position == len(buffer):
+            text = next(texts, None)
+            if text is None:
+                raise ValueError('Файл оборвался до конца списка')
+            buffer, position = text, 0
+            continue
+        if not started:
+            if buffer[position] != '[':
+                raise ValueError('Ожидался список пар слов')
+            started = True
+            position += 1
+            continue
+        if buffer[position] == ']':
+            return
+        if buffer[position] == ',':
+            position += 1
+            continue
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item may continue in the next chunk.
+            text = next(texts, None)
+            if text is None:
+                raise
+            buffer, position = buffer[position:] + text, 0
+            continue
+        yield item
+        if position > READ_SIZE:
+            buffer, position = buffer[position:], 0
+
+def iter_json_pairs(texts):
+    """Yields (ru_word, en_word) of the Word items in base_dict.json format."""
+    for item in iter_json_items(texts):
+        if not isinstance(item, dict) or item.get('model') != 'Word':
+            continue
+        fields = item.get('fields') or {}
+        yield fields.get('ru_word'), fields.get('en_word')
+
+def iter_csv_pairs(texts):
+    """Yields (ru_word, en_word) from the first two columns of CSV rows."""
+    for number, row in enumerate(csv.reader(_lines(texts))):
+        if not row:
+            continue
+        if number == 0 and tuple(cell.strip().lower()
+                                 for cell in row[:2]) == CSV_HEADER:
+            continue
+        if len(row) < 2:
+            yield None, None
+            continue
+        yield row[0], row[1]
+
+def read_pairs(chunks, file_name, is_valid):
+    """
+    Parses an uploaded vocabulary file as it is read.
+
+    Args:
+        chunks (iterable): The bytes of the file.
+        file_name (str): The file name, its extension selects the format.
+        is_valid (callable): Checks a (ru_word, en_word) pair.
+
+    Returns:
+        tuple: The generator of valid lower-cased pairs and a dict with
+               the 'rejected' count, which is updated while reading.
+    """
+    parse = (iter_csv_pairs if file_format(file_name) == '.csv'
+             else iter_json_pairs)
+    counts = {'rejected': 0}
+
+    def pairs():
+        for ru_word, en_word in parse(decode(chunks)):
+            if isinstance(ru_word, str) and isinstance(en_word, str):
+                pair = ru_word.strip().lower(), en_word.strip().lower()
+                if is_valid(*pair):
+                    yield pair
+                    continue
+            counts['rejected'] += 1
+
+    return pairs(), counts
@@ -0,0 +1,159 @@
+import hmac
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Receives updates from Telegram over HTTP and hands them to the bot.
+
+    Every POST is acknowledged as soon as its body is queued. A dispatcher
+    thread collects queued updates into batches of up to batch_size (or
+    whatever arrived within batch_timeout seconds) and passes each batch
+    to bot.process_new_updates, which runs the handlers on the bot's
+    worker pool.
+
+    Attributes:
+        bot (TeleBot): The bot whose handlers process the updates.
+        secret_token (str): The value expected in the secret token header,
+                            must not be empty.
+        path (str): The URL path the updates are posted to.
+        batch_size (int): The maximum number of updates per batch.
+        batch_timeout (float): How long to wait for a batch to fill up.
+    """
+    def __init__(self, bot, host = '127.0.0.1', port = 8443,
+                 secret_token = '', path = '/webhook', batch_size = 100,
+                 batch_timeout = 0.05, max_queue = 10000):
+        if not secret_token:
+            raise ValueError('Webhook не принимает обновления без '
+                             'секретного токена')
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.updates = queue.Queue(maxsize = max_queue)
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._dispatcher = None
+        self._stopped = threading.Event()
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+                token = self.headers.get(SECRET_HEADER, '')
+                if not hmac.compare_digest(token.encode(),
+                                           server.secret_token.encode()):
+                    self.send_error(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    server.updates.put_nowait(self.rfile.read(length))
+                except queue.Full:
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return WebhookHandler
+
+    def start(self):
+        self._start_dispatcher()
+        threading.Thread(target = self.httpd.serve_forever,
+                         name = 'webhook-http', daemon = True).start()
+
+    def serve_forever(self):
+        self._start_dispatcher()
+        logger.info('Webhook слушает %s:%s%s', *self.httpd.server_address[:2],
+                    self.path)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stopped.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _start_dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target = self._dispatch,
+                                                name = 'webhook-dispatch',
+                                                daemon = True)
+            self._dispatcher.start()
+
+    def _next_batch(self):
+        try:
+            batch = [self.updates.get(timeout = 1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.updates.get(timeout = remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _dispatch(self):
+        while not self._stopped.is_set():
+            updates = []
+            for body in self._next_batch():
+                try:
+                    updates.append(Update.de_json(json.loads(body)))
+                except (ValueError, KeyError, TypeError):
+                    logger.warning('Пропущено некорректное обновление: %r',
+                                   body[:200])
+            if not updates:
+                continue
+            try:
+                self.bot.process_new_updates(updates)
+            except Exception:
+                logger.exception('Ошибка при обработке пакета обновлений')
+
+
+def create_webhook_server(bot, config):
+    # Without a secret anyone could post forged updates. A webhook the bot
+    # registers itself gets a random one; a webhook registered elsewhere
+    # must be given the secret it was registered with.
+    secret_token = config.get('Webhook', 'secret_token', fallback = '')
+    if not secret_token:
+        if not config.get('Webhook', 'url', fallback = ''):
+            raise ValueError('Укажите secret_token в секции [Webhook] '
+                             'settings.ini')
+        secret_token = secrets.token_urlsafe(32)
+    return WebhookServer(
+        bot,
+        host = config.get('Webhook', 'host', fallback = '127.0.0.1'),
+        port = config.getint('Webhook', 'port', fallback = 8443),
+        secret_token = secret_token,
+        path = config.get('Webhook', 'path', fallback = '/webhook'),
+        batch_size = config.getint('Webhook', 'batch_size', fallback = 100),
+        batch_timeout = config.getfloat('Webhook', 'batch_timeout',
+                                        fallback = 0.05),
+        max_queue = config.getint('Webhook', 'max_queue', fallback = 10000)
+    )